@@ -16,6 +16,7 @@ pythonPackages.buildPythonPackage rec {
     nixUnstable
     generate_programs_index
     progress
-    pygit2
+    git
+    xz
   ];
 }
@@ -7,7 +7,7 @@ setup(name='nixipfs',
       author='Maximilian Güntner',
       author_email='code@sourcediver.org',
       url='https://github.com/NixIPFS/nixipfs-scripts',
-      scripts=['create_channel_release','create_nixipfs','release_nixos','update_binary_cache', 'garbage_collect', 'mirror_tarballs'],
+      scripts=['create_channel_release','create_nixipfs','release_nixos','update_binary_cache', 'garbage_collect', 'mirror_tarballs', 'benchmark'],
       packages=['nixipfs'],
       package_dir={'nixipfs': 'src'},
       )
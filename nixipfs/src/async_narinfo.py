@@ -0,0 +1,244 @@
+import asyncio
+import os
+import ssl
+import time
+import traceback
+import urllib.error
+import urllib.parse
+
+from nixipfs.metrics import get_metrics
+from nixipfs.download_helpers import DownloadFailed, narinfo_fetches
+from nixipfs.concurrency import AdaptiveLimiter, is_congestion, backoff_delay
+from nixipfs.http_client import REDIRECT_CODES, MAX_REDIRECTS
+from nixipfs.defaults import *
+
+class AsyncHTTPClient:
+    """Minimal HTTP/1.1 client on asyncio streams with per-host keep-alive.
+    Only what is needed to fetch small files like .narinfo."""
+    def __init__(self, timeout=DEFAULT_HTTP_TIMEOUT):
+        self.timeout = timeout
+        self.pools = {}
+        self.ssl_context = ssl.create_default_context()
+        self.counters = { 'requests' : 0, 'connections' : 0, 'reused' : 0, 'redirects' : 0, 'errors' : 0 }
+
+    def summary(self):
+        s = self.counters
+        return "{} requests over {} connections ({} reused, {} redirects, {} errors)".format(
+            s['requests'], s['connections'], s['reused'], s['redirects'], s['errors'])
+
+    def close(self):
+        for pool in self.pools.values():
+            for reader, writer in pool:
+                writer.close()
+        self.pools = {}
+
+    async def _acquire(self, key):
+        pool = self.pools.get(key)
+        if pool:
+            self.counters['reused'] += 1
+            return pool.pop(), True
+        self.counters['connections'] += 1
+        scheme, host, port = key
+        conn = await asyncio.open_connection(host, port,
+                                             ssl=self.ssl_context if scheme == 'https' else None)
+        return conn, False
+
+    def _release(self, key, conn, reusable):
+        if reusable:
+            self.pools.setdefault(key, []).append(conn)
+        else:
+            conn[1].close()
+
+    async def _read_headers(self, reader):
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in [ b'\r\n', b'\n', b'' ]:
+                return headers
+            t = line.decode('latin-1').split(':', 1)
+            if len(t) == 2:
+                headers[t[0].strip().lower()] = t[1].strip()
+
+    async def _read_body(self, reader, headers):
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0].strip(), 16)
+                if size == 0:
+                    await self._read_headers(reader)
+                    return b''.join(body), True
+                body.append(await reader.readexactly(size))
+                await reader.readline()
+        elif 'content-length' in headers:
+            return await reader.readexactly(int(headers['content-length'])), True
+        else:
+            return await reader.read(), False
+
+    async def _request_once(self, url, headers):
+        u = urllib.parse.urlsplit(url)
+        if u.scheme not in [ 'http', 'https' ]:
+            raise urllib.error.URLError("unsupported url scheme: {}".format(url))
+        port = u.port or (443 if u.scheme == 'https' else 80)
+        key = (u.scheme, u.hostname, port)
+        target = urllib.parse.urlunsplit(('', '', u.path or '/', u.query, ''))
+        h = { 'Host' : u.netloc, 'User-Agent' : DEFAULT_HTTP_USER_AGENT }
+        h.update(headers)
+        request = "GET {} HTTP/1.1\r\n{}\r\n".format(target,
+                    "".join([ "{}: {}\r\n".format(k, v) for k, v in h.items() ])).encode('latin-1')
+
+        # A reused connection may have been closed by the server, retry that once on a new one
+        for attempt in range(2):
+            try:
+                conn, reused = await self._acquire(key)
+            except OSError as e:
+                # refused, unresolvable or failed TLS handshake, like the errors below
+                self.counters['errors'] += 1
+                raise urllib.error.URLError(e)
+            reader, writer = conn
+            start = time.monotonic()
+            try:
+                writer.write(request)
+                await writer.drain()
+                status_line = await reader.readline()
+                get_metrics().observe('http_async', time.monotonic() - start)
+                if not status_line:
+                    raise ConnectionResetError("connection closed by server")
+                version, status = status_line.decode('latin-1').split(' ', 2)[:2]
+                resp_headers = await self._read_headers(reader)
+                body, framed = await self._read_body(reader, resp_headers)
+                break
+            except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+                writer.close()
+                if not reused or attempt == 1:
+                    self.counters['errors'] += 1
+                    raise urllib.error.URLError(e)
+            except BaseException:
+                # cancelled (by the timeout in fetch) half way through the request
+                writer.close()
+                raise
+        keep_alive = (framed and version == 'HTTP/1.1'
+                      and resp_headers.get('connection', '').lower() != 'close')
+        self._release(key, conn, keep_alive)
+        self.counters['requests'] += 1
+        return int(status), resp_headers, body
+
+    async def fetch(self, url, headers={}):
+        for x in range(MAX_REDIRECTS + 1):
+            try:
+                status, resp_headers, body = await asyncio.wait_for(
+                    self._request_once(url, headers), self.timeout)
+            except asyncio.TimeoutError:
+                self.counters['errors'] += 1
+                raise urllib.error.URLError("timeout: {}".format(url))
+            if status in REDIRECT_CODES and 'location' in resp_headers:
+                url = urllib.parse.urljoin(url, resp_headers['location'])
+                self.counters['redirects'] += 1
+                continue
+            if status >= 400:
+                self.counters['errors'] += 1
+                raise urllib.error.HTTPError(url, status, body.decode('utf8', 'replace')[:200], resp_headers, None)
+            return body
+        raise urllib.error.URLError("too many redirects: {}".format(url))
+
+async def fetch_narinfo_async(client, path, binary_cache, local_cache = None, tries = DEFAULT_DOWNLOAD_TRIES, index = None, limiter = None):
+    # Same lookup order as download_helpers.fetch_file_from_cache
+    if index is not None:
+        res = index.get(path)
+        if res:
+            return res
+    if local_cache is not None:
+        local_path = os.path.join(local_cache, path)
+        if os.path.isfile(local_path):
+            with open(local_path, "r") as f:
+                res = f.read()
+            if len(res):
+                return res
+    url = "{}/{}".format(binary_cache, path)
+    # shared with the threads of releases that are synced at the same time
+    future, owner = narinfo_fetches.claim(url)
+    if not owner:
+        return await asyncio.wrap_future(future)
+    res = ""
+    try:
+        res = await _fetch_narinfo(client, url, tries, limiter)
+    finally:
+        narinfo_fetches.finish(url, future, res)
+    return res
+
+async def _fetch_narinfo(client, url, tries, limiter):
+    for x in range(0, tries):
+        start = time.monotonic()
+        try:
+            res = (await client.fetch(url)).decode('utf8')
+            if limiter is not None:
+                limiter.record(True, time.monotonic() - start)
+            if len(res):
+                return res
+        except (urllib.error.HTTPError, urllib.error.URLError) as e:
+            if limiter is not None and is_congestion(e):
+                limiter.record(False)
+            await asyncio.sleep(backoff_delay(x, e))
+    return ""
+
+async def _collect(nic, binary_cache, local_cache, max_requests, index, limiter):
+    client = AsyncHTTPClient()
+    pending = {}
+    last_progress = time.monotonic()
+    try:
+        # nic.queue is only fed by turn_in, which runs on this loop, so it is
+        # safe to drain it without blocking
+        while pending or not nic.queue.empty():
+            # every request holds one of the limiter's slots, which are shared
+            # with the threads that download NARs from the same cache
+            while len(pending) < max_requests and not nic.queue.empty() and limiter.try_acquire():
+                work = nic.get_work()
+                task = asyncio.ensure_future(fetch_narinfo_async(client, work, binary_cache, local_cache,
+                                                                 index=index, limiter=limiter))
+                pending[task] = work
+            if not pending:
+                # all slots are taken by NAR downloads, wait until one is free
+                await asyncio.get_event_loop().run_in_executor(None, limiter.acquire)
+                limiter.release()
+                continue
+            done, _ = await asyncio.wait(list(pending.keys()), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                limiter.release()
+                work = pending.pop(task)
+                try:
+                    narinfo = task.result()
+                except Exception:
+                    # anything fetch_narinfo_async does not handle ends this path, not the walk
+                    traceback.print_exc()
+                    narinfo = ""
+                if len(narinfo):
+                    try:
+                        nic.turn_in(work, narinfo)
+                        continue
+                    except DownloadFailed as e:
+                        print(e)
+                    except Exception:
+                        traceback.print_exc()
+                else:
+                    print("Could not fetch {}".format(work))
+                nic.give_up(work)
+            if time.monotonic() - last_progress >= DEFAULT_PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                print("narinfo: {} collected, {} in flight, {}".format(
+                    nic.collected, len(pending), limiter.summary()))
+    finally:
+        client.close()
+    get_metrics().add('http_async', client.counters)
+    print("narinfo: {}".format(client.summary()))
+
+def collect_narinfos_async(nic, binary_cache, local_cache = None, max_requests = DEFAULT_ASYNC_NARINFO_REQUESTS, index = None, limiter = None):
+    """Walks the closure started with nic.start() using up to max_requests
+    concurrent requests on a single event loop. The number of requests in
+    flight follows limiter (see concurrency.AdaptiveLimiter), which may be
+    shared with threads that use the same server."""
+    if limiter is None:
+        limiter = AdaptiveLimiter('update_binary_cache.narinfo', maximum=max_requests)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(_collect(nic, binary_cache, local_cache, max_requests, index, limiter))
+    finally:
+        loop.close()
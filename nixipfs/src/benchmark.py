@@ -0,0 +1,358 @@
+import hashlib
+import http.server
+import json
+import math
+import os
+import random
+import shutil
+import socketserver
+import struct
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from nixipfs.nix_helpers import encode_hash, NarInfo
+from nixipfs.ipfs_dag import B58_ALPHABET
+from nixipfs.metrics import get_metrics
+from nixipfs.defaults import *
+
+# Runs the release tools against local stand-ins for Hydra, the binary cache
+# and the IPFS API, so their throughput can be measured without network access.
+
+PROJECT = "bench"
+JOBSET = "bench"
+JOB = "tested"
+CHANNEL = "nixpkgs-bench"
+
+def nar_str(s):
+    return struct.pack('<Q', len(s)) + s + b'\0' * (-len(s) % 8)
+
+def nar_regular(contents):
+    return b''.join([ nar_str(s) for s in [ b'(', b'type', b'regular', b'contents', contents, b')' ] ])
+
+def nar_directory(entries):
+    """entries maps names (bytes) to serialized nodes"""
+    res = [ nar_str(b'('), nar_str(b'type'), nar_str(b'directory') ]
+    for name in sorted(entries.keys()):
+        res += [ nar_str(b'entry'), nar_str(b'('), nar_str(b'name'), nar_str(name),
+                 nar_str(b'node'), entries[name], nar_str(b')') ]
+    return b''.join(res + [ nar_str(b')') ])
+
+def make_nar(node):
+    return nar_str(b'nix-archive-1') + node
+
+def fake_cid(data):
+    # CIDv0 of the sha256 of the data, good enough to be parsed by ipfs_dag
+    n = int.from_bytes(b'\x12\x20' + hashlib.sha256(data).digest(), 'big')
+    res = ''
+    while n:
+        n, r = divmod(n, 58)
+        res = B58_ALPHABET[r] + res
+    return res
+
+class SyntheticCache:
+    """A random closure graph served as a binary cache.
+
+    The store paths are distributed over depth levels, every path references
+    refs paths of deeper levels and is referenced by at least one path of
+    the level above. Level 0 holds the roots of the releases."""
+    def __init__(self, paths=1000, depth=6, refs=3, nar_size=(1024, 64 * 1024), churn=0.1, seed=1):
+        self.rng = random.Random(seed)
+        self.files = {}
+        self.nar_size = nar_size
+        per_level = max(1, paths // depth)
+        # the extra roots replace some of the first release's roots in the second one
+        extra = int(math.ceil(per_level * churn))
+        levels = [ [ self.new_path("bench-{}-{}".format(l, i)) for i in range(per_level + (extra if l == 0 else 0)) ]
+                   for l in range(depth) ]
+        references = { p : set() for level in levels for p in level }
+        for l in range(1, depth):
+            for p in levels[l]:
+                references[self.rng.choice(levels[l - 1])].add(p)
+        for l in range(depth - 1):
+            deeper = [ p for level in levels[l + 1:] for p in level ]
+            for p in levels[l]:
+                references[p].update(self.rng.sample(deeper, min(refs, len(deeper))))
+        for p, r in references.items():
+            self.add_path(p, make_nar(nar_regular(os.urandom(self.rng.randint(*nar_size)))), r)
+        roots = levels[0]
+        self.roots = [ roots[:per_level], roots[:per_level - extra] + roots[per_level:] ]
+        self.paths = len(references)
+
+        tarball = self.new_path("nixexprs-tarball")
+        self.tarball = tarball + "/tarballs/nixexprs.tar.gz"
+        self.add_path(tarball, make_nar(nar_directory(
+            { b'tarballs' : nar_directory({ b'nixexprs.tar.gz' : nar_regular(os.urandom(nar_size[1])) }) })), [])
+        self.files['nix-cache-info'] = b'StoreDir: /nix/store\nWantMassQuery: 1\nPriority: 40\n'
+
+    def new_path(self, name):
+        h = encode_hash(bytes([ self.rng.randrange(256) for i in range(20) ]), "base32")
+        return "/nix/store/{}-{}".format(h, name)
+
+    def add_path(self, path, nar, references):
+        file_hash = "sha256:" + encode_hash(hashlib.sha256(nar).digest(), "base32")
+        url = "nar/{}.nar".format(file_hash.split(':')[1])
+        ni = NarInfo()
+        ni.d = { 'StorePath' : path,
+                 'URL' : url,
+                 'Compression' : 'none',
+                 'FileHash' : file_hash,
+                 'FileSize' : str(len(nar)),
+                 'NarHash' : file_hash,
+                 'NarSize' : str(len(nar)),
+                 'References' : " ".join(sorted([ os.path.basename(r) for r in references ])) }
+        self.files[url] = nar
+        self.files[os.path.basename(path).split('-')[0] + ".narinfo"] = ni.to_string().encode('utf-8')
+
+class ThreadingServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 drops connections of the async narinfo client
+    request_queue_size = 1024
+
+class FakeServer:
+    """HTTP/1.1 server on localhost, requests are answered by handle() after
+    an optional delay to simulate the round trip to a remote server."""
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.counters = { 'requests' : 0, 'sent' : 0, 'received' : 0, 'errors' : 0 }
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.dispatch(self, 'GET')
+
+            def do_POST(self):
+                server.dispatch(self, 'POST')
+
+        self.httpd = ThreadingServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.port)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def read_body(self, req):
+        if req.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = []
+            while True:
+                size = int(req.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    req.rfile.readline()
+                    return b''.join(body)
+                body.append(req.rfile.read(size))
+                req.rfile.readline()
+        return req.rfile.read(int(req.headers.get('Content-Length', 0)))
+
+    def dispatch(self, req, method):
+        u = urllib.parse.urlsplit(req.path)
+        body = self.read_body(req)
+        if self.latency:
+            time.sleep(self.latency)
+        status, content_type, data, *extra = self.handle(method, u.path, urllib.parse.parse_qs(u.query), req.headers, body)
+        with self.lock:
+            self.counters['requests'] += 1
+            self.counters['sent'] += len(data)
+            self.counters['received'] += len(body)
+            if status >= 400:
+                self.counters['errors'] += 1
+        req.send_response(status)
+        req.send_header('Content-Type', content_type)
+        req.send_header('Content-Length', str(len(data)))
+        for name, value in (extra[0] if len(extra) else {}).items():
+            req.send_header(name, value)
+        req.end_headers()
+        req.wfile.write(data)
+
+    def handle(self, method, path, query, headers, body):
+        return 404, 'text/plain', b'not found'
+
+class FakeBinaryCache(FakeServer):
+    def __init__(self, cache, latency=0.0):
+        self.cache = cache
+        FakeServer.__init__(self, latency)
+
+    def handle(self, method, path, query, headers, body):
+        data = self.cache.files.get(path.lstrip('/'))
+        if data is None:
+            return 404, 'text/plain', b'not found'
+        # single ranges are enough for resumed and segmented downloads
+        r = headers.get('Range', '')
+        if r.startswith('bytes='):
+            start, end = r[len('bytes='):].split('-')
+            start = int(start)
+            end = min(int(end) if len(end) else len(data) - 1, len(data) - 1)
+            return 206, 'application/octet-stream', data[start:end + 1], {
+                'Accept-Ranges' : 'bytes', 'Content-Range' : 'bytes {}-{}/{}'.format(start, end, len(data)) }
+        return 200, 'application/octet-stream', data, { 'Accept-Ranges' : 'bytes' }
+
+class FakeHydra(FakeServer):
+    """Serves the evaluation self.current, every release of the synthetic
+    cache is one evaluation"""
+    def __init__(self, cache, latency=0.0):
+        self.cache = cache
+        self.current = 1
+        FakeServer.__init__(self, latency)
+
+    def handle(self, method, path, query, headers, body):
+        p = path.strip('/').split('/')
+        res = None
+        if p == [ 'job', PROJECT, JOBSET, JOB, 'latest-finished' ]:
+            res = { 'id' : self.current, 'nixname' : 'bench-{}'.format(self.current), 'jobsetevals' : [ self.current ] }
+        elif len(p) >= 2 and p[0] == 'eval' and p[1] == str(self.current):
+            if len(p) == 2:
+                res = { 'jobsetevalinputs' : { 'nixpkgs' : { 'revision' : '{:040x}'.format(self.current) } } }
+            elif p[2:] == [ 'store-paths' ]:
+                res = self.cache.roots[self.current - 1]
+            elif len(p) == 4 and p[2] == 'job' and p[3] == 'tarball':
+                res = { 'buildproducts' : { '1' : { 'path' : self.cache.tarball, 'sha256hash' : '' } } }
+        if res is None:
+            return 404, 'text/plain', b'not found'
+        data = json.dumps(res).encode('utf-8')
+        etag = '"{}"'.format(hashlib.sha256(data).hexdigest()[:16])
+        if headers.get('If-None-Match') == etag:
+            return 304, 'application/json', b'', { 'ETag' : etag }
+        return 200, 'application/json', data, { 'ETag' : etag }
+
+class FakeIPFS(FakeServer):
+    """Implements the subset of the IPFS HTTP API that create_nixipfs uses.
+    Added files get the CID of their sha256, nothing is stored."""
+    def handle(self, method, path, query, headers, body):
+        cmd = path[len('/api/v0/'):] if path.startswith('/api/v0/') else None
+        args = query.get('arg', [])
+        if cmd == 'version':
+            res = { 'Version' : '0.4.13' }
+        elif cmd == 'add':
+            res = [ { 'Name' : name, 'Hash' : fake_cid(data), 'Size' : str(len(data)) }
+                    for name, data in self.multipart(headers, body) ]
+        elif cmd == 'object/put':
+            res = { 'Hash' : fake_cid(b''.join([ data for name, data in self.multipart(headers, body) ])) }
+        elif cmd == 'files/stat':
+            res = { 'Hash' : fake_cid(args[0].encode('utf-8')) }
+        elif cmd == 'name/publish':
+            res = { 'Name' : 'bench', 'Value' : args[0] }
+        elif cmd in [ 'files/mkdir', 'files/cp', 'files/flush', 'pin/add' ]:
+            res = {}
+        else:
+            return 404, 'text/plain', b'not found'
+        if isinstance(res, list):
+            return 200, 'application/json', b''.join([ json.dumps(r).encode('utf-8') + b'\n' for r in res ])
+        return 200, 'application/json', json.dumps(res).encode('utf-8')
+
+    def multipart(self, headers, body):
+        """Yields (file name, contents) of a multipart/form-data body"""
+        boundary = headers.get('Content-Type', '').split('boundary=')[-1].strip('"').encode('utf-8')
+        for part in body.split(b'--' + boundary)[1:]:
+            if part.startswith(b'--'):
+                break
+            head, _, data = part.partition(b'\r\n\r\n')
+            name = b''
+            for line in head.split(b'\r\n'):
+                if b'filename=' in line:
+                    name = line.split(b'filename=')[1].strip(b'"')
+            yield urllib.parse.unquote(name.decode('utf-8')), data[:-2]
+
+def measure(report, name, servers, func):
+    """Runs func and records wall time and the requests each server received"""
+    before = { n : s.stats() for n, s in servers.items() }
+    start = time.monotonic()
+    res = func()
+    duration = time.monotonic() - start
+    entry = { 'seconds' : duration }
+    for n, s in servers.items():
+        after = s.stats()
+        entry[n] = { k : after[k] - before[n][k] for k in after.keys() }
+    report[name] = entry
+    return res
+
+def print_report(report):
+    for name, entry in report.items():
+        line = "{:28} {:8.2f}s".format(name, entry['seconds'])
+        if 'items' in entry:
+            line += " {:8} items {:10.1f}/s".format(entry['items'], entry['items'] / max(entry['seconds'], 0.001))
+        for n, s in entry.items():
+            if isinstance(s, dict) and s['requests']:
+                line += "  {}: {} req, {:.1f} MB".format(n, s['requests'], (s['sent'] + s['received']) / 1e6)
+        print(line)
+
+def benchmark(workdir=None, paths=1000, depth=6, refs=3, nar_size=(1024, 64 * 1024), churn=0.1,
+              latency=0.0, ipfs_latency=0.0, concurrent=DEFAULT_CONCURRENT_DOWNLOADS,
+              async_narinfo=False, delta=False, ipfs=True, ipfs_threads=DEFAULT_IPFS_THREADS, build_dag=False, seed=1):
+    """Releases two evaluations of a synthetic closure, adds them to IPFS and
+    collects the garbage of the first one. Returns the report as a dict."""
+    from nixipfs.create_channel_release import create_channel_release
+    from nixipfs.update_binary_cache import update_binary_cache
+    from nixipfs.garbage_collect import garbage_collect
+
+    print("Generating {} store paths".format(paths))
+    cache = SyntheticCache(paths, depth, refs, nar_size, churn, seed)
+    servers = { 'cache' : FakeBinaryCache(cache, latency), 'hydra' : FakeHydra(cache, latency) }
+    if ipfs:
+        servers['ipfs'] = FakeIPFS(ipfs_latency)
+    cleanup = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix='nixipfs-benchmark')
+    outdir = os.path.join(workdir, 'out')
+    tmpdir = os.path.join(workdir, 'tmp')
+    releases_dir = os.path.join(outdir, 'releases')
+    os.makedirs(tmpdir, exist_ok=True)
+    os.makedirs(releases_dir, exist_ok=True)
+
+    report = {}
+    release_paths = []
+    try:
+        for r in [ 1, 2 ]:
+            servers['hydra'].current = r
+            path = measure(report, 'create_channel_release.{}'.format(r), servers,
+                           lambda: create_channel_release(CHANNEL, servers['hydra'].url, PROJECT, JOBSET, JOB,
+                                                          servers['cache'].url, releases_dir, tmpdir))
+            release_paths.append(path)
+            measure(report, 'update_binary_cache.{}'.format(r), servers,
+                    lambda: update_binary_cache(servers['cache'].url, path, outdir, concurrent,
+                                                async_narinfo=async_narinfo, delta=delta))
+            # items are the store paths in the closure of the release
+            report['update_binary_cache.{}'.format(r)]['items'] = len(os.listdir(os.path.join(path, 'binary_cache', 'nar')))
+        # A sync without a new evaluation
+        measure(report, 'create_channel_release.noop', servers,
+                lambda: create_channel_release(CHANNEL, servers['hydra'].url, PROJECT, JOBSET, JOB,
+                                               servers['cache'].url, releases_dir, tmpdir))
+        if ipfs:
+            try:
+                from nixipfs.create_nixipfs import create_nixipfs
+                measure(report, 'create_nixipfs', servers,
+                        lambda: create_nixipfs(outdir, ('127.0.0.1', servers['ipfs'].port), ipfs_threads, build_dag))
+            except ImportError as e:
+                print("Skipping create_nixipfs: {}".format(e))
+        shutil.rmtree(release_paths[0])
+        count, size = measure(report, 'garbage_collect', servers,
+                              lambda: garbage_collect(os.path.join(outdir, 'binary_cache'), release_paths[1:]))
+        report['garbage_collect']['items'] = count
+    finally:
+        for s in servers.values():
+            s.stop()
+        if cleanup:
+            shutil.rmtree(workdir)
+    print_report(report)
+    return { 'parameters' : { 'paths' : cache.paths, 'depth' : depth, 'refs' : refs, 'nar_size' : list(nar_size),
+                              'churn' : churn, 'latency' : latency, 'ipfs_latency' : ipfs_latency,
+                              'concurrent' : concurrent, 'async_narinfo' : async_narinfo, 'delta' : delta },
+             'stages' : report,
+             'metrics' : get_metrics().report() }
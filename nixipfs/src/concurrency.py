@@ -0,0 +1,222 @@
+import collections
+import concurrent.futures
+import contextlib
+import http.client
+import os
+import random
+import socket
+import threading
+import time
+import urllib.error
+
+from nixipfs.metrics import get_metrics
+from nixipfs.defaults import *
+
+def is_congestion(e):
+    """True for errors that mean the server (or the way to it) is overloaded,
+    a missing file is an answer and not a reason to slow down"""
+    if isinstance(e, urllib.error.HTTPError):
+        return e.code == 429 or e.code >= 500
+    return isinstance(e, (urllib.error.URLError, ConnectionError, http.client.HTTPException, socket.timeout))
+
+def retry_after(e):
+    # Seconds a 429/503 asked us to wait, 0 if the server did not say
+    headers = getattr(e, 'headers', None)
+    if headers is None:
+        return 0
+    try:
+        return max(0, int(headers.get('Retry-After', 0)))
+    except (TypeError, ValueError):
+        return 0
+
+def backoff_delay(attempt, e=None, base=DEFAULT_HTTP_ERROR_SLEEP, cap=DEFAULT_BACKOFF_CAP):
+    """Exponential backoff with full jitter: uniform in [0, min(cap, base * 2^attempt)],
+    workers that failed at the same time do not retry at the same time"""
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if e is not None:
+        delay = max(delay, min(cap, retry_after(e)))
+    return delay
+
+class AdaptiveLimiter:
+    """AIMD limit on the number of concurrent requests to one server.
+
+    Until the first sign of congestion every successful response grows the
+    limit by one (slow start, it doubles per round of requests), afterwards by
+    1/limit, i.e. by one per round. The limit only grows while the average
+    latency stays below DEFAULT_LATENCY_TOLERANCE times the best latency seen.
+    Congestion errors (see is_congestion) halve the limit, slow responses
+    shrink it slightly; both at most once per DEFAULT_BACKOFF_WINDOW since a
+    burst of errors is caused by one overload. Other failures (404, hash
+    mismatches) leave the limit as it is. Threads take a slot with slot(),
+    code that schedules on its own (asyncio) takes slots with try_acquire()
+    and reports with record()."""
+    def __init__(self, name, initial=DEFAULT_INITIAL_CONCURRENCY, maximum=DEFAULT_CONCURRENT_DOWNLOADS, minimum=1):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.value = float(min(self.maximum, max(minimum, initial)))
+        self.active = 0
+        self.best = None
+        self.avg = None
+        self.last_decrease = 0
+        self.slow_start = True
+        self.errors = 0
+        self.peak = int(self.value)
+        self.cond = threading.Condition()
+
+    @property
+    def limit(self):
+        return int(self.value)
+
+    def _decrease(self, factor):
+        now = time.monotonic()
+        if now - self.last_decrease < DEFAULT_BACKOFF_WINDOW:
+            return
+        self.last_decrease = now
+        self.slow_start = False
+        self.value = max(self.minimum, self.value * factor)
+
+    def record(self, ok, latency=None):
+        with self.cond:
+            if not ok:
+                self.errors += 1
+                self._decrease(DEFAULT_AIMD_DECREASE)
+            else:
+                congested = False
+                if latency is not None:
+                    self.best = latency if self.best is None else min(self.best, latency)
+                    self.avg = latency if self.avg is None else 0.9 * self.avg + 0.1 * latency
+                    congested = self.avg > max(self.best, DEFAULT_LATENCY_FLOOR) * DEFAULT_LATENCY_TOLERANCE
+                if congested:
+                    self._decrease(DEFAULT_LATENCY_DECREASE)
+                else:
+                    step = 1.0 if self.slow_start else 1.0 / self.value
+                    self.value = min(self.maximum, self.value + step)
+                    self.peak = max(self.peak, self.limit)
+            self.cond.notify_all()
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+
+    def try_acquire(self):
+        # acquire() for code that must not block
+        with self.cond:
+            if self.active >= self.limit:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+    @contextlib.contextmanager
+    def slot(self, latency=True):
+        """Holds one of the limit slots for a request and records its outcome,
+        latency=False for transfers whose duration depends on their size"""
+        self.acquire()
+        start = time.monotonic()
+        try:
+            yield
+        except BaseException as e:
+            # a missing file or a corrupt download says nothing about the load
+            if is_congestion(e):
+                self.record(False)
+            raise
+        else:
+            self.record(True, time.monotonic() - start if latency else None)
+        finally:
+            self.release()
+
+    def summary(self):
+        return "concurrency {} (peak {}, max {}), {} congestion errors".format(
+            self.limit, self.peak, self.maximum, self.errors)
+
+    def report(self):
+        get_metrics().set(self.name, { 'concurrency' : self.limit,
+                                       'concurrency_peak' : self.peak,
+                                       'congestion_errors' : self.errors })
+
+@contextlib.contextmanager
+def limited(limiter, latency=True):
+    # limiter.slot() if there is a limiter
+    if limiter is None:
+        yield
+    else:
+        with limiter.slot(latency):
+            yield
+
+class DiskBudget:
+    """Number of bytes concurrent downloads may occupy on a file system at once"""
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self.cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def reserve(self, n):
+        # something larger than the whole budget waits until it has it for itself
+        n = min(n, self.size)
+        with self.cond:
+            while self.used + n > self.size:
+                self.cond.wait()
+            self.used += n
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.used -= n
+                self.cond.notify_all()
+
+class Inflight:
+    """Work that is done at most once at a time per key, e.g. the download of
+    a file that concurrent releases share. A caller that finds the key busy
+    gets the result (or exception) of the caller that is doing the work.
+    The last keep results are handed out as well, until the caller that did
+    the work has stored its result where the others look first."""
+    def __init__(self, keep=0):
+        self.lock = threading.Lock()
+        self.running = {}
+        self.keep = keep
+        self.done = collections.OrderedDict()
+
+    def claim(self, key):
+        """Returns (future, True) if the caller has to do the work and hand
+        the outcome to finish(), otherwise (future, False) to wait on"""
+        with self.lock:
+            future = self.running.get(key) or self.done.get(key)
+            if future is not None:
+                return future, False
+            future = self.running[key] = concurrent.futures.Future()
+            return future, True
+
+    def finish(self, key, future, result=None, exception=None):
+        with self.lock:
+            del self.running[key]
+            if self.keep and exception is None and result:
+                self.done[key] = future
+                if len(self.done) > self.keep:
+                    self.done.popitem(last=False)
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def run(self, key, func):
+        future, owner = self.claim(key)
+        if not owner:
+            return future.result()
+        try:
+            result = func()
+        except BaseException as e:
+            self.finish(key, future, exception=e)
+            raise
+        self.finish(key, future, result)
+        return result
+
+# Hashing whole files is CPU bound, concurrent releases share one slot per core
+hashing_slots = threading.BoundedSemaphore(os.cpu_count() or 1)
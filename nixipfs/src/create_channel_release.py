@@ -1,34 +1,57 @@
 #!/usr/bin/env python3
 import os
+import shutil
 import subprocess
 import tempfile
 import tarfile
 import lzma
 import sys
+import threading
+import time
 import traceback
 
 from nixipfs.karkinos import *
 from nixipfs.hydra_helpers import *
 from nixipfs.download_helpers import *
-from nixipfs.utils import ccd
+from nixipfs.metrics import get_metrics
+from nixipfs.hydra_cache import ResponseCache
+from nixipfs.tar_helpers import extract_until, rewrite_tar_xz
+from nixipfs.defaults import *
+
+# generate-programs-index is CPU heavy and all releases share its files cache
+programs_index_l = threading.Lock()
 
 # This is very close to that what the NixOS release script does.
 # A general approach to release an arbitrary jobset is still missing but it should be
 # easier to extend now with the Karkinos class and helper functions
 def create_channel_release(channel, hydra, project, jobset, job, cache, outdir, tmpdir, target_cache=None):
-    release_info = ReleaseInfo(fetch_release_info(hydra, project, jobset, job))
-    k = Karkinos(hydra, release_info.eval_id)
+    # Hydra responses are cached in outdir, unchanged ones are not transferred again
+    os.makedirs(outdir, exist_ok=True)
+    response_cache = ResponseCache(os.path.join(outdir, "hydra-cache.sqlite"))
+    try:
+        response_cache.expire(DEFAULT_HYDRA_CACHE_MAX_AGE)
+        return release_channel(channel, hydra, project, jobset, job, cache, outdir, tmpdir, target_cache, response_cache)
+    finally:
+        response_cache.close()
+
+def release_channel(channel, hydra, project, jobset, job, cache, outdir, tmpdir, target_cache, response_cache):
+    start = time.monotonic()
+    # latest-finished alone tells whether there is anything new, the
+    # (large) evaluation is only fetched for a release that does not exist yet
+    release_info = ReleaseInfo(fetch_release_info(hydra, project, jobset, job, response_cache))
+    out_dir = os.path.abspath(os.path.join(outdir, channel, release_info.name))
+    if os.path.isfile(os.path.join(out_dir, 'git-revision')):
+        get_metrics().record('create_channel_release.hydra', time.monotonic() - start)
+        return out_dir
+    k = Karkinos(hydra, release_info.eval_id, cache, response_cache)
     eval_info = EvalInfo(k.fetch_eval_info())
     store_paths = k.fetch_store_paths()
+    get_metrics().record('create_channel_release.hydra', time.monotonic() - start)
     files_cache = os.path.join(outdir, "nixos-files.sqlite")
 
-    out_dir = os.path.abspath(os.path.join(outdir, channel, release_info.name))
     tmp_dir = os.path.abspath(tmpdir)
     assert(os.path.isdir(tmp_dir))
 
-    if os.path.isfile(os.path.join(out_dir, 'git-revision')):
-        return out_dir
-
     os.makedirs(out_dir, exist_ok=True)
     with open(os.path.join(out_dir, "src-url"), "w") as f:
         f.write(k.eval_url)
@@ -46,48 +69,56 @@ def create_channel_release(channel, hydra, project, jobset, job, cache, outdir,
     with lzma.open(os.path.join(out_dir, 'store-paths.xz'), 'w') as f:
         f.write("\n".join(set(store_paths)).encode('utf-8'))
 
+    start = time.monotonic()
     if channel.startswith('nixos'):
-        k.download_file('nixos.channel', out_dir, 'nixexprs.tar.xz', tmp_dir=tmp_dir)
-        k.download_file('nixos.iso_minimal.x86_64-linux', out_dir, tmp_dir=tmp_dir)
+        required = [ ('nixos.channel', 'nixexprs.tar.xz') ]
+        optional = [ ('nixos.iso_minimal.x86_64-linux', '') ]
         if not channel.endswith('-small'):
-            k.download_file('nixos.iso_minimal.i686-linux', out_dir, tmp_dir=tmp_dir)
-            k.download_file('nixos.iso_graphical.x86_64-linux', out_dir, tmp_dir=tmp_dir)
-            k.download_file('nixos.ova.x86_64-linux', out_dir, tmp_dir=tmp_dir)
+            optional += [ ('nixos.iso_minimal.i686-linux', ''),
+                          ('nixos.iso_graphical.x86_64-linux', ''),
+                          ('nixos.ova.x86_64-linux', '') ]
     else:
-        k.download_file('tarball', out_dir, 'nixexprs.tar.gz', tmp_dir=tmp_dir)
+        required = [ ('tarball', 'nixexprs.tar.gz') ]
+        optional = []
+    # The budget only counts running downloads, a full disk is not made any fuller
+    budget = min(DEFAULT_ARTIFACT_DISK_BUDGET, shutil.disk_usage(out_dir).free)
+    failures = k.download_files(required + optional, out_dir, tmp_dir=tmp_dir, budget=budget)
+    get_metrics().record('create_channel_release.artifacts', time.monotonic() - start)
+    get_metrics().add('create_channel_release.artifacts', { 'files' : len(required + optional) - len(failures),
+                                                            'failed' : len(failures) })
+    for jobname, e in failures:
+        print("Could not download {} of {}: {}".format(jobname, release_info.name, e))
+    # A release without the nix expressions is useless, the others are left out
+    for jobname, e in failures:
+        if jobname in [ r[0] for r in required ]:
+            raise DownloadFailed("Could not download {} of {}".format(jobname, release_info.name))
 
     if channel.startswith('nixos'):
         nixexpr_tar = os.path.join(out_dir, 'nixexprs.tar.xz')
-        with tarfile.open(nixexpr_tar, "r:xz") as nixexpr:
-            if any([s for s in nixexpr.getnames() if 'programs.sqlite' in s]):
-                contains_programs = True
-            else:
-                contains_programs = False
-
-        if not contains_programs:
-            with tempfile.TemporaryDirectory() as temp_dir:
-                nixexpr = tarfile.open(nixexpr_tar, 'r:xz')
-                nixexpr.extractall(temp_dir)
-                nixexpr.close()
+        with tempfile.TemporaryDirectory(dir=tmp_dir) as temp_dir:
+            # The tree is extracted while looking for programs.sqlite, if it is
+            # there the scan stops early and the tree is not needed
+            contains_programs = extract_until(nixexpr_tar, temp_dir, lambda name: 'programs.sqlite' in name) is not None
 
+            if not contains_programs:
                 expr_dir = os.path.join(temp_dir, os.listdir(temp_dir)[0])
+                programs = os.path.join(temp_dir, 'programs.sqlite')
 
                 try:
-                    subprocess.check_call('generate-programs-index {} {} {} {} {}'.format(
-                                    files_cache,
-                                    os.path.join(expr_dir, 'programs.sqlite'),
-                                    cache,
-                                    os.path.join(out_dir, 'store-paths'),
-                                    os.path.join(expr_dir,'nixpkgs')),
-                                    shell=True)
-                    os.remove(os.path.join(expr_dir, 'programs.sqlite-journal'))
-                    os.remove(nixexpr_tar)
-                    nixexpr = tarfile.open(nixexpr_tar, 'w:xz')
-                    with ccd(temp_dir):
-                        nixexpr.add(os.listdir()[0])
-                    nixexpr.close()
+                    with programs_index_l, get_metrics().stage('create_channel_release.programs_index'):
+                        subprocess.check_call('generate-programs-index {} {} {} {} {}'.format(
+                                        files_cache,
+                                        programs,
+                                        cache,
+                                        os.path.join(out_dir, 'store-paths'),
+                                        os.path.join(expr_dir,'nixpkgs')),
+                                        shell=True)
                 except(subprocess.CalledProcessError):
                     print("Could not execute {}".format("generate-programs-index"))
+                else:
+                    with get_metrics().stage('create_channel_release.nixexprs'):
+                        rewrite_tar_xz(nixexpr_tar, nixexpr_tar,
+                                       [ (programs, os.path.join(os.path.basename(expr_dir), 'programs.sqlite')) ])
 
     with open(os.path.join(out_dir, "git-revision"), "w") as f:
         f.write(eval_info.git_rev)
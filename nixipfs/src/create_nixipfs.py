@@ -4,10 +4,16 @@ import ipfsapi
 import contextlib
 import hashlib
 import time
+import queue
+import threading
 from glob import glob
 
 from nixipfs.nix_helpers import *
 from nixipfs.utils import LJustBar
+from nixipfs.ipfs_dag import DagBuilder
+from nixipfs.ipfs_hash_cache import IPFSHashCache
+from nixipfs.metrics import get_metrics
+from nixipfs.defaults import *
 
 RELEASE_VALID_PATHS=['binary-cache-url', 'git-revision', 'nixexprs.tar.xz', '.iso', 'src-url', 'store-paths.xz']
 ADD_OPTIONS={'pin':'false', 'raw-leaves': 'true'}
@@ -18,80 +24,206 @@ def files_flush(api, path, **kwargs):
     args = (path,)
     return api._client.request('/files/flush', args=args, **kwargs)
 
-def add_binary_cache(api, local_dir, mfs_dir, hash_cache):
+class IPFSPool:
+    """Runs IPFS API calls on up to max_threads threads, each with its own client"""
+    def __init__(self, ipfs_api, max_threads=DEFAULT_IPFS_THREADS, batch_size=DEFAULT_IPFS_ADD_BATCH):
+        self.ipfs_api = ipfs_api
+        self.max_threads = max_threads
+        self.batch_size = batch_size
+        self.local = threading.local()
+
+    @property
+    def api(self):
+        if getattr(self.local, 'api', None) is None:
+            self.local.api = ipfsapi.connect(self.ipfs_api[0], self.ipfs_api[1])
+        return self.local.api
+
+    def run(self, message, func, batches):
+        # func is called with each batch (a list), progress is counted per item
+        work = queue.Queue()
+        lock = threading.Lock()
+        errors = []
+        bar = LJustBar(message, max=sum([ len(b) for b in batches ]))
+
+        def worker():
+            while True:
+                batch = work.get()
+                if batch is None:
+                    break
+                try:
+                    func(batch)
+                except Exception as e:
+                    with lock:
+                        errors.append(e)
+                with lock:
+                    bar.next(len(batch))
+                work.task_done()
+
+        for batch in batches:
+            work.put(batch)
+        threads = []
+        for i in range(min(self.max_threads, max(len(batches), 1))):
+            t = threading.Thread(target=worker)
+            threads.append(t)
+            t.start()
+        work.join()
+        for t in threads:
+            work.put(None)
+        for t in threads:
+            t.join()
+        bar.finish()
+        if len(errors):
+            raise errors[0]
+
+    def add(self, message, paths):
+        """Adds local files in batches, returns { path : hash }"""
+        res = {}
+        lock = threading.Lock()
+
+        def add_batch(batch):
+            call_start = time.monotonic()
+            added = self.api.add(batch, recursive=False, opts=ADD_OPTIONS)
+            get_metrics().observe('ipfs_add', time.monotonic() - call_start)
+            if isinstance(added, dict):
+                added = [ added ]
+            # the API only reports the base names
+            paths = { os.path.basename(p) : p for p in batch }
+            with lock:
+                res.update({ paths[os.path.basename(a['Name'])] : a['Hash'] for a in added })
+
+        start = time.time()
+        self.run(message, add_batch, [ paths[i:i+self.batch_size] for i in range(0, len(paths), self.batch_size) ])
+        size = sum([ os.path.getsize(p) for p in paths ])
+        print_throughput(message, len(paths), size, time.time() - start)
+        get_metrics().record('create_nixipfs.add', time.time() - start)
+        get_metrics().add('create_nixipfs.add', { 'files' : len(paths), 'bytes' : size,
+                                                  'requests' : (len(paths) + self.batch_size - 1) // self.batch_size })
+        return res
+
+    def cp(self, message, copies):
+        """copies is a list of (ipfs hash, mfs path)"""
+        def cp_batch(batch):
+            for obj, dest in batch:
+                call_start = time.monotonic()
+                self.api.files_cp("/ipfs/" + obj, dest, opts=FILES_OPTIONS)
+                get_metrics().observe('ipfs_files_cp', time.monotonic() - call_start)
+
+        start = time.time()
+        self.run(message, cp_batch, [ copies[i:i+self.batch_size] for i in range(0, len(copies), self.batch_size) ])
+        print_throughput(message, len(copies), None, time.time() - start)
+        get_metrics().record('create_nixipfs.cp', time.time() - start)
+        get_metrics().add('create_nixipfs.cp', { 'files' : len(copies), 'requests' : len(copies) })
+
+def print_throughput(message, files, size, duration):
+    if files == 0:
+        return
+    duration = max(duration, 0.001)
+    if size is None:
+        print("{}: {} files in {:.1f}s ({:.1f} files/s)".format(message, files, duration, files / duration))
+    else:
+        print("{}: {} files, {:.1f} MB in {:.1f}s ({:.1f} files/s, {:.1f} MB/s)".format(
+            message, files, size / 1e6, duration, files / duration, size / 1e6 / duration))
+
+def add_binary_cache(api, pool, local_dir, mfs_dir, hash_cache, dag=None):
     binary_cache_dir = os.path.join(local_dir, 'binary_cache')
     nar_dir = os.path.join(binary_cache_dir, 'nar')
 
     mfs_binary_cache_dir = os.path.join(mfs_dir, 'binary_cache')
     mfs_nar_dir = os.path.join(mfs_binary_cache_dir, 'nar')
 
-    api.files_mkdir(mfs_binary_cache_dir)
-    api.files_mkdir(mfs_nar_dir)
+    if dag is None:
+        api.files_mkdir(mfs_binary_cache_dir)
+        api.files_mkdir(mfs_nar_dir)
 
     nar_files = [ e for e in os.listdir(nar_dir) if '.nar' in e ]
-    bar = LJustBar('Adding .nar', max=len(nar_files))
-    for idx, nar in enumerate(nar_files):
-        bar.next()
-        if hash_cache.get(nar) is None:
-            nar_path = os.path.join(nar_dir, nar)
-            hash_cache.update({ nar : api.add(nar_path, recursive=False, opts=ADD_OPTIONS)['Hash']})
-    bar.finish()
-
-    bar = LJustBar('Copying .nar', max=len(nar_files))
-    for idx, nar in enumerate(sorted(nar_files)):
-        bar.next()
-        api.files_cp("/ipfs/" + hash_cache[nar], os.path.join(mfs_nar_dir, nar), opts=FILES_OPTIONS)
-    bar.finish()
-
-    if os.path.isfile(os.path.join(binary_cache_dir, 'nix-cache-info')):
-        api.files_cp("/ipfs/" + api.add(os.path.join(binary_cache_dir, 'nix-cache-info'), opts=ADD_OPTIONS)['Hash'],
-                                        os.path.join(mfs_binary_cache_dir, 'nix-cache-info'), opts=FILES_OPTIONS)
+    nar_hashes = { nar : hash_cache.get(os.path.join(nar_dir, nar)) for nar in nar_files }
+    added = pool.add('Adding .nar', [ os.path.join(nar_dir, nar) for nar, h in nar_hashes.items() if h is None ])
+    hash_cache.update(added)
+    nar_hashes.update({ os.path.basename(path) : h for path, h in added.items() })
+    if dag is None:
+        pool.cp('Copying .nar', [ (nar_hashes[nar], os.path.join(mfs_nar_dir, nar)) for nar in sorted(nar_files) ])
+
+    cache_info_hash = None
+    cache_info_path = os.path.join(binary_cache_dir, 'nix-cache-info')
+    if os.path.isfile(cache_info_path):
+        cache_info_hash = hash_cache.get(cache_info_path)
+        if cache_info_hash is None:
+            cache_info_hash = api.add(cache_info_path, opts=ADD_OPTIONS)['Hash']
+            hash_cache.update({ cache_info_path : cache_info_hash })
+        if dag is None:
+            api.files_cp("/ipfs/" + cache_info_hash, os.path.join(mfs_binary_cache_dir, 'nix-cache-info'), opts=FILES_OPTIONS)
 
     narinfo_files = [ e for e in os.listdir(binary_cache_dir) if e.endswith('.narinfo') ]
-    bar = LJustBar('Adding .narinfo', max=len(narinfo_files))
-    for idx, nip in enumerate(narinfo_files):
-        bar.next()
-        ni_hash = hash_cache.get(nip)
-        if ni_hash is None:
+    narinfo_hashes = { nip : hash_cache.get(os.path.join(binary_cache_dir, nip)) for nip in narinfo_files }
+    new_narinfos = []
+    for nip, h in narinfo_hashes.items():
+        if h is None:
             with open(os.path.join(binary_cache_dir, nip), 'r') as f:
                 ni = NarInfo(f.read())
-            ni.d['IPFSHash'] = hash_cache[ni.d['URL'].split('/')[1]]
+            ni.d['IPFSHash'] = nar_hashes[ni.d['URL'].split('/')[1]]
             with open(os.path.join(binary_cache_dir, nip), 'w') as f:
                 f.write("\n".join(ni.dump()+['']))
-            ni_hash = api.add(os.path.join(binary_cache_dir, nip), recursive=False, opts=ADD_OPTIONS)['Hash']
-            hash_cache.update({nip : ni_hash})
-    bar.finish()
-
-    bar = LJustBar('Copying .narinfo', max=len(narinfo_files))
-    for idx, nip in enumerate(sorted(narinfo_files)):
-        bar.next()
-        api.files_cp("/ipfs/" + hash_cache[nip], os.path.join(mfs_binary_cache_dir, nip), opts=FILES_OPTIONS)
-    bar.finish()
+            new_narinfos.append(os.path.join(binary_cache_dir, nip))
+    # the identity of the rewritten files is recorded
+    added = pool.add('Adding .narinfo', new_narinfos)
+    hash_cache.update(added)
+    narinfo_hashes.update({ os.path.basename(path) : h for path, h in added.items() })
+
+    if dag is not None:
+        return add_binary_cache_dag(api, dag, binary_cache_dir, mfs_binary_cache_dir,
+                                    nar_hashes, narinfo_hashes, cache_info_hash)
+
+    pool.cp('Copying .narinfo', [ (narinfo_hashes[nip], os.path.join(mfs_binary_cache_dir, nip)) for nip in sorted(narinfo_files) ])
     files_flush(api, mfs_binary_cache_dir)
     return api.files_stat(mfs_binary_cache_dir)['Hash']
 
-def add_nixos_release(api, local_dir, mfs_dir, hash_cache):
-    # if the directory has been added to IPFS once, reuse that hash
-    hash_file = os.path.join(local_dir, "ipfs_hash")
-    if os.path.isfile(hash_file):
+def add_binary_cache_dag(api, dag, binary_cache_dir, mfs_binary_cache_dir, nar_hashes, narinfo_hashes, cache_info_hash):
+    # The directory nodes are built from the known hashes and linked into MFS with a single files_cp.
+    # Link sizes are the local file sizes, which is exact for files that fit into one raw block.
+    start = time.time()
+    puts = dag.puts
+    nar_dir = os.path.join(binary_cache_dir, 'nar')
+    nar_entries = { nar : (h, os.path.getsize(os.path.join(nar_dir, nar))) for nar, h in nar_hashes.items() }
+    entries = { nip : (h, os.path.getsize(os.path.join(binary_cache_dir, nip))) for nip, h in narinfo_hashes.items() }
+    entries['nar'] = dag.directory(nar_entries)
+    if cache_info_hash is not None:
+        entries['nix-cache-info'] = (cache_info_hash, os.path.getsize(os.path.join(binary_cache_dir, 'nix-cache-info')))
+    binary_cache_hash, _ = dag.directory(entries)
+    api.files_cp("/ipfs/" + binary_cache_hash, mfs_binary_cache_dir, opts=FILES_OPTIONS)
+    print("Building binary_cache: {} entries in {} object puts, {:.1f}s".format(
+        len(entries) + len(nar_entries), dag.puts - puts, time.time() - start))
+    return binary_cache_hash
+
+def release_fingerprint(local_dir, files):
+    # Changes whenever a release file is replaced or links are added to/removed from its binary cache
+    parts = []
+    for f in sorted(files) + [ 'binary_cache', os.path.join('binary_cache', 'nar') ]:
+        path = os.path.join(local_dir, f)
+        if os.path.exists(path):
+            st = os.stat(path)
+            parts.append("{}:{}:{}:{}".format(f, st.st_size, st.st_mtime_ns, st.st_ino))
+    return hashlib.sha256("\n".join(parts).encode('utf-8')).hexdigest()
+
+def add_nixos_release(api, pool, local_dir, mfs_dir, hash_cache, dag=None):
+    files = [ x for x in os.listdir(local_dir) if [ y for y in RELEASE_VALID_PATHS if y in x ]]
+    fingerprint = release_fingerprint(local_dir, files)
+    # if the unchanged directory has been added to IPFS once, reuse that hash
+    dir_hash = hash_cache.get_dir(local_dir, fingerprint)
+    if dir_hash is not None:
         api.files_mkdir(os.path.dirname(mfs_dir), parents=True)
-        with open(hash_file, 'r') as f:
-            api.files_cp("/ipfs/" + f.read().strip(), mfs_dir, opts=FILES_OPTIONS)
+        api.files_cp("/ipfs/" + dir_hash, mfs_dir, opts=FILES_OPTIONS)
     else:
         api.files_mkdir(mfs_dir, parents=True)
         file_hashes = {}
-        files = [ x for x in os.listdir(local_dir) if [ y for y in RELEASE_VALID_PATHS if y in x ]]
         bar = LJustBar('Adding file', max=len(files))
         for f in files:
             bar.next()
             file_path = os.path.join(local_dir, f)
-            if hash_cache.get(f) is not None:
-                file_hashes.update({ f : hash_cache[f] })
-            else:
-                h = api.add(file_path, recursive=False, opts=ADD_OPTIONS)['Hash'] 
-                file_hashes.update({ f : h})
-                if f.endswith(".iso") or f.endswith(".ova"):
-                    hash_cache.update({f : h})
+            h = hash_cache.get(file_path)
+            if h is None:
+                h = api.add(file_path, recursive=False, opts=ADD_OPTIONS)['Hash']
+                hash_cache.update({ file_path : h })
+            file_hashes.update({ f : h })
         bar.finish()
 
         bar = LJustBar('Adding file', max=len(file_hashes))
@@ -99,38 +231,55 @@ def add_nixos_release(api, local_dir, mfs_dir, hash_cache):
             bar.next()
             api.files_cp("/ipfs/" + obj, os.path.join(mfs_dir, name), opts=FILES_OPTIONS)
         bar.finish()
-        add_binary_cache(api, local_dir, mfs_dir, hash_cache)
-        with open(hash_file, 'w') as f:
-            f.write(api.files_stat(mfs_dir)['Hash'].strip())
+        add_binary_cache(api, pool, local_dir, mfs_dir, hash_cache, dag)
+        hash_cache.update_dir(local_dir, fingerprint, api.files_stat(mfs_dir)['Hash'].strip())
     files_flush(api, mfs_dir)
 
-def create_nixipfs(local_dir, ipfs_api):
+def import_legacy_hash_cache(hash_cache, legacy_file, local_dir):
+    # ipfs_hashes used to map bare file names to hashes, only the names that
+    # can be found in the global binary cache can be carried over
+    binary_cache_dir = os.path.join(local_dir, 'binary_cache')
+    hashes = {}
+    with open(legacy_file, 'r') as f:
+        for line in f.readlines():
+            if line.count(':') != 1:
+                continue
+            name, h = [ e.strip() for e in line.split(':') ]
+            for path in [ os.path.join(binary_cache_dir, name), os.path.join(binary_cache_dir, 'nar', name) ]:
+                if os.path.isfile(path):
+                    hashes[path] = h
+    hash_cache.update(hashes)
+    print('imported {} hashes from {}'.format(len(hashes), legacy_file))
+
+def create_nixipfs(local_dir, ipfs_api, max_threads=DEFAULT_IPFS_THREADS, build_dag=False):
     api = ipfsapi.connect(ipfs_api[0], ipfs_api[1])
-    hash_cache = {}
-    hash_cache_file = os.path.join(local_dir, 'ipfs_hashes')
+    pool = IPFSPool(ipfs_api, max_threads)
+    dag = DagBuilder(api) if build_dag else None
+    hash_cache_file = os.path.join(local_dir, 'ipfs_hashes.sqlite')
+    legacy_hash_cache_file = os.path.join(local_dir, 'ipfs_hashes')
+    new_cache = not os.path.isfile(hash_cache_file)
+    hash_cache = IPFSHashCache(hash_cache_file)
     nixfs_dir = '{}_{}'.format('/nixfs', int(time.time()))
     channels_dir = os.path.join(local_dir, 'channels')
     releases_dir = os.path.join(local_dir, 'releases')
 
-    if os.path.isfile(hash_cache_file):
-        with open(hash_cache_file, 'r') as f:
-            hash_cache.update(dict([ [e.split(':')[0].strip(),
-                                      e.split(':')[1].strip() ] for e in f.readlines() ]))
+    if new_cache and os.path.isfile(legacy_hash_cache_file):
+        import_legacy_hash_cache(hash_cache, legacy_hash_cache_file, local_dir)
     api.files_mkdir(nixfs_dir)
 
     # Add global binary cache
     print('adding global cache...')
-    add_binary_cache(api, local_dir, nixfs_dir, hash_cache)
+    add_binary_cache(api, pool, local_dir, nixfs_dir, hash_cache, dag)
 
     # Add all releases
     for release_name in [ e.rstrip('/') for e in glob(releases_dir + '/*/')]:
         for release_dir in [ e.rstrip('/') for e in glob(release_name + '/*/')]:
             print('adding release: {}'.format(os.path.basename(release_dir)))
-            add_nixos_release(api, release_dir, os.path.join(nixfs_dir, 'releases', os.path.basename(release_name), os.path.basename(release_dir)), hash_cache)
+            add_nixos_release(api, pool, release_dir, os.path.join(nixfs_dir, 'releases', os.path.basename(release_name), os.path.basename(release_dir)), hash_cache, dag)
     # Add all channels
     for channel_dir in [ e.rstrip('/') for e in glob(channels_dir + '/*/')]:
         print('adding channel: {}'.format(os.path.basename(channel_dir)))
-        add_nixos_release(api, channel_dir, os.path.join(nixfs_dir, 'channels', os.path.basename(channel_dir)), hash_cache)
+        add_nixos_release(api, pool, channel_dir, os.path.join(nixfs_dir, 'channels', os.path.basename(channel_dir)), hash_cache, dag)
 
     nixfs_hash = api.files_stat(nixfs_dir)['Hash']
     print('flushing...')
@@ -140,5 +289,4 @@ def create_nixipfs(local_dir, ipfs_api):
     api.pin_add(nixfs_hash)
     ret = api.name_publish('/ipfs/' + nixfs_hash, lifetime="2h")
     print('published {} to /ipns/{}'.format(ret['Value'], ret['Name']))
-    with open(hash_cache_file, 'w') as f:
-        f.write("\n".join([ "{}:{}".format(k,v) for k,v in hash_cache.items() ]))
+    hash_cache.close()
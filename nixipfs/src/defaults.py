@@ -5,3 +5,34 @@ DEFAULT_DOWNLOAD_TRIES=3
 DEFAULT_HTTP_ERROR_SLEEP=5
 DEFAULT_BINARY_CACHE_URL="https://cache.nixos.org"
 DEFAULT_HYDRA="https://hydra.nixos.org"
+DEFAULT_HASH_CHUNK_SIZE=1024*1024
+DEFAULT_HTTP_POOL_SIZE=64
+DEFAULT_HTTP_TIMEOUT=60
+DEFAULT_HTTP_USER_AGENT="nixipfs"
+DEFAULT_ASYNC_NARINFO_REQUESTS=256
+DEFAULT_IPFS_THREADS=4
+DEFAULT_IPFS_ADD_BATCH=32
+DEFAULT_HAMT_THRESHOLD=256*1024
+DEFAULT_GC_BATCH=1000
+DEFAULT_STORE_DELETE_BATCH=256
+DEFAULT_SOURCE_CACHE_SIZE=3
+DEFAULT_PARALLEL_RELEASES=2
+DEFAULT_DOWNLOAD_SEGMENTS=4
+DEFAULT_SEGMENT_SIZE=64*1024*1024
+DEFAULT_JOURNAL_INTERVAL=8*1024*1024
+DEFAULT_INITIAL_CONCURRENCY=4
+DEFAULT_AIMD_DECREASE=0.5
+DEFAULT_LATENCY_DECREASE=0.9
+DEFAULT_LATENCY_TOLERANCE=3
+DEFAULT_LATENCY_FLOOR=0.01
+DEFAULT_BACKOFF_WINDOW=1
+DEFAULT_BACKOFF_CAP=60
+DEFAULT_PROGRESS_INTERVAL=10
+DEFAULT_HYDRA_CACHE_MAX_AGE=30*24*3600
+DEFAULT_ARTIFACT_DOWNLOADS=4
+DEFAULT_ARTIFACT_DISK_BUDGET=8*1024*1024*1024
+DEFAULT_NAR_DISK_BUDGET=4*1024*1024*1024
+DEFAULT_XZ_THREADS=0
+DEFAULT_XZ_PRESET=6
+DEFAULT_INDEX_BATCH=1000
+DEFAULT_INFLIGHT_NARINFOS=10000
@@ -1,4 +1,5 @@
 import json
+import http.client
 import urllib.request
 import tempfile
 import os
@@ -11,87 +12,392 @@ import threading
 import time
 from shutil import copyfile
 
-from nixipfs.nix_helpers import nar_info_from_path, NarInfo
+from nixipfs.nix_helpers import nar_info_from_path, NarInfo, MultiHash, NarReader, NarError
 from nixipfs.utils import ccd
+from nixipfs.http_client import get_client
+from nixipfs.metrics import get_metrics
+from nixipfs.concurrency import limited, backoff_delay, hashing_slots, Inflight
 from nixipfs.defaults import *
 
 class DownloadFailed(Exception):
     pass
 
-def fetch_json(url):
-    req = urllib.request.Request(url, headers = { "Content-Type" : "application/json",
-                                                  "Accept" : "application/json" })
-    return json.loads(urllib.request.urlopen(req).read().decode('utf8'))
+class HashMismatch(Exception):
+    pass
+
+class ResumeFailed(urllib.error.URLError):
+    pass
+
+def split_file_hash(file_hash):
+    # "sha256:1b4sb..." -> ("sha256", "1b4sb...")
+    t = file_hash.split(':', 1)
+    return t[0].strip(), t[1].strip()
 
-def fetch_file_from_cache(path, binary_cache = DEFAULT_BINARY_CACHE_URL, local_cache = None, force = False, tries = DEFAULT_DOWNLOAD_TRIES):
+def fetch_json(url, cache = None, immutable = False):
+    """With a hydra_cache.ResponseCache the request is conditional (ETag/Last-Modified),
+    immutable responses are taken from the cache without asking the server"""
+    headers = { "Content-Type" : "application/json",
+                "Accept" : "application/json" }
+    cached = cache.get(url) if cache is not None else None
+    if cached is not None and immutable:
+        get_metrics().count('hydra', 'cached')
+        return json.loads(cached.body.decode('utf8'))
+    if cached is not None:
+        headers.update(cached.validators())
+    with get_client().request(url, headers) as r:
+        res = r.read()
+        if r.status == 304 and cached is not None:
+            get_metrics().count('hydra', 'not_modified')
+            return json.loads(cached.body.decode('utf8'))
+        if cache is not None:
+            cache.put(url, r.getheader('ETag'), r.getheader('Last-Modified'), res)
+    return json.loads(res.decode('utf8'))
+
+def fetch_file_from_cache(path, binary_cache = DEFAULT_BINARY_CACHE_URL, local_cache = None, force = False, tries = DEFAULT_DOWNLOAD_TRIES, index = None, limiter = None):
     res = ""
-    if not (local_cache == None and force == False):
+    if index is not None:
+        res = index.get(path) or ""
+    if not len(res) and not (local_cache == None and force == False):
         local_path = os.path.join(local_cache, path)
         if os.path.isfile(local_path):
             with open(local_path, "r") as f:
                 res = f.read()
     if not len(res):
         url = "{}/{}".format(binary_cache, path)
-        for x in range(0, tries):
-            try:
-                req = urllib.request.Request(url)
-                res = urllib.request.urlopen(url).read().decode('utf8')
-                if len(res):
-                    break
-            except (urllib.error.ContentTooShortError, urllib.error.HTTPError, urllib.error.URLError):
-                time.sleep(DEFAULT_HTTP_ERROR_SLEEP)
+        # releases that are synced concurrently share most of their narinfos
+        res = narinfo_fetches.run(url, lambda: fetch_narinfo(url, tries, limiter))
+    return res
+
+def fetch_narinfo(url, tries = DEFAULT_DOWNLOAD_TRIES, limiter = None):
+    res = ""
+    for x in range(0, tries):
+        try:
+            with limited(limiter):
+                res = get_client().fetch(url).decode('utf8')
+            if len(res):
+                break
+        except (urllib.error.ContentTooShortError, urllib.error.HTTPError, urllib.error.URLError, http.client.HTTPException) as e:
+            get_metrics().count('download.narinfo', 'failed_attempts')
+            time.sleep(backoff_delay(x, e))
     return res
 
-def download_file_from_cache(path, dest, binary_cache = DEFAULT_BINARY_CACHE_URL, tries = DEFAULT_DOWNLOAD_TRIES):
+# Requests in flight of all releases that are processed concurrently
+narinfo_fetches = Inflight(keep=DEFAULT_INFLIGHT_NARINFOS)
+nar_downloads = Inflight()
+
+class DownloadJournal:
+    """Progress of a partial download, kept next to its .part file.
+
+    The file is split into segments [start, end), pos is the offset up to
+    which a segment has been written. A journal is only kept if the server
+    announced the length and supports range requests."""
+    def __init__(self, path, url, length, etag, segments):
+        self.path = path
+        self.url = url
+        self.length = length
+        self.etag = etag
+        self.segments = segments
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, url):
+        try:
+            with open(path, 'r') as f:
+                d = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if d.get('url') != url:
+            return None
+        return cls(path, url, d['length'], d.get('etag'), d['segments'])
+
+    def save(self):
+        with self.lock:
+            data = json.dumps({ 'url' : self.url, 'length' : self.length, 'etag' : self.etag, 'segments' : self.segments })
+            with open(self.path + '.tmp', 'w') as f:
+                f.write(data)
+            os.replace(self.path + '.tmp', self.path)
+
+    def update(self, idx, pos):
+        self.segments[idx][2] = pos
+        self.save()
+
+    def pending(self):
+        return [ idx for idx, (start, end, pos) in enumerate(self.segments) if pos < end ]
+
+def partial_paths(dest):
+    # Partial downloads live in .partial/ so they are never mistaken for complete files
+    partial_dir = os.path.join(os.path.dirname(os.path.abspath(dest)), '.partial')
+    os.makedirs(partial_dir, exist_ok=True)
+    part = os.path.join(partial_dir, os.path.basename(dest))
+    return part, part + '.json'
+
+def split_segments(length, segments = DEFAULT_DOWNLOAD_SEGMENTS, min_size = DEFAULT_SEGMENT_SIZE):
+    n = max(1, min(segments, length // min_size))
+    bounds = [ length * i // n for i in range(n + 1) ]
+    return [ [ bounds[i], bounds[i + 1], bounds[i] ] for i in range(n) ]
+
+def request_range(url, start, end, journal):
+    r = get_client().request(url, headers = { 'Range' : 'bytes={}-{}'.format(start, end - 1) })
+    # "bytes 100-199/1000", the file must not have changed since the journal was started
+    content_range = r.getheader('Content-Range', '')
+    if (r.status != 206 or not content_range.startswith('bytes {}-'.format(start)) or
+            content_range.rsplit('/', 1)[-1] not in [ '*', str(journal.length) ] or
+            (journal.etag is not None and r.getheader('ETag') not in [ None, journal.etag ])):
+        r.close()
+        raise ResumeFailed("{} can not be resumed at {}".format(url, start))
+    return r
+
+def fetch_segment(url, part, journal, idx, hashers = [], resp = None):
+    start, end, pos = journal.segments[idx]
+    if resp is None:
+        resp = request_range(url, pos, end, journal)
+    saved = pos
+    with resp, open(part, 'r+b') as f:
+        f.seek(pos)
+        while pos < end:
+            chunk = resp.read(min(DEFAULT_HASH_CHUNK_SIZE, end - pos))
+            if not chunk:
+                break
+            f.write(chunk)
+            for h in hashers:
+                h.update(chunk)
+            pos += len(chunk)
+            if pos - saved >= DEFAULT_JOURNAL_INTERVAL:
+                f.flush()
+                journal.update(idx, pos)
+                saved = pos
+        f.flush()
+    journal.update(idx, pos)
+    if pos < end:
+        raise urllib.error.ContentTooShortError(
+            "retrieval incomplete: got only {} out of {} bytes".format(pos, journal.length), None)
+
+def fetch_segments(url, part, journal, first = None):
+    # first is an already open response from the start of the file
+    errors = []
+    def worker(idx):
+        try:
+            fetch_segment(url, part, journal, idx, resp = first if idx == 0 else None)
+        except Exception as e:
+            errors.append(e)
+    threads = [ threading.Thread(target=worker, args=(idx, )) for idx in journal.pending() ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if len(errors):
+        raise errors[0]
+
+def hash_file(path, hashers, length):
+    with hashing_slots, open(path, 'rb') as f:
+        remaining = length
+        while remaining:
+            chunk = f.read(min(DEFAULT_HASH_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            for h in hashers:
+                h.update(chunk)
+
+def stream_url_to_file(url, dest, file_hash = None, hasher = None):
+    # The body is hashed while it is written to a partial file below dest's directory.
+    # dest only appears (atomically) once the download is complete and verified.
+    # An additional MultiHash can be passed as hasher to get more digests in the same pass.
+    # Interrupted downloads are continued with range requests, large files are
+    # fetched in parallel segments.
+    if file_hash is not None:
+        hash_type, hash_value = split_file_hash(file_hash)
+        mh = MultiHash([ hash_type ])
+    else:
+        mh = None
+    hashers = [ h for h in [ mh, hasher ] if h is not None ]
+    part, journal_path = partial_paths(dest)
+    journal = DownloadJournal.load(journal_path, url) if os.path.isfile(part) else None
+    try:
+        if journal is not None:
+            get_metrics().count('download', 'resumed')
+            if len(journal.segments) == 1:
+                # sequential download, the prefix on disk is hashed and the rest streamed
+                hash_file(part, hashers, journal.segments[0][2])
+                fetch_segment(url, part, journal, 0, hashers)
+            else:
+                fetch_segments(url, part, journal)
+                hash_file(part, hashers, journal.length)
+        else:
+            r = get_client().request(url)
+            length = r.getheader('Content-Length')
+            resumable = length is not None and r.getheader('Accept-Ranges', '').lower() == 'bytes'
+            with open(part, 'wb') as f:
+                if resumable:
+                    f.truncate(int(length))
+            if resumable:
+                journal = DownloadJournal(journal_path, url, int(length), r.getheader('ETag'), split_segments(int(length)))
+                journal.save()
+            if journal is not None and len(journal.segments) > 1:
+                get_metrics().count('download', 'segmented')
+                fetch_segments(url, part, journal, r)
+                hash_file(part, hashers, journal.length)
+            elif journal is not None:
+                fetch_segment(url, part, journal, 0, hashers, r)
+            else:
+                size = 0
+                with r, open(part, 'wb') as f:
+                    while True:
+                        chunk = r.read(DEFAULT_HASH_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        size += len(chunk)
+                        f.write(chunk)
+                        for h in hashers:
+                            h.update(chunk)
+                if length is not None and size < int(length):
+                    raise urllib.error.ContentTooShortError(
+                        "retrieval incomplete: got only {} out of {} bytes".format(size, length), None)
+        if mh is not None and mh.hexdigest(hash_type, "base32") != hash_value:
+            raise HashMismatch("Hash verification for {} failed".format(url))
+        os.replace(part, dest)
+        if os.path.exists(journal_path):
+            os.unlink(journal_path)
+    except BaseException as e:
+        # Only a journaled download that failed on the way can be continued
+        if journal is None or isinstance(e, (HashMismatch, ResumeFailed)):
+            for path in [ part, journal_path ]:
+                if os.path.exists(path):
+                    os.unlink(path)
+        raise
+
+def download_file_from_cache(path, dest, binary_cache = DEFAULT_BINARY_CACHE_URL, tries = DEFAULT_DOWNLOAD_TRIES, file_hash = None, limiter = None):
+    # A file is downloaded by one thread at a time, they would share its partial file
+    nar_downloads.run(dest, lambda: download_file(path, dest, binary_cache, tries, file_hash, limiter))
+
+def download_file(path, dest, binary_cache, tries, file_hash, limiter):
     url = "{}/{}".format(binary_cache, path)
 
     for x in range(0, tries):
-        holdoff = DEFAULT_HTTP_ERROR_SLEEP*x
         try:
-            urllib.request.urlretrieve(url, dest)
+            # the duration of a NAR download depends on its size, only errors adjust the limit
+            with limited(limiter, latency=False):
+                stream_url_to_file(url, dest, file_hash)
             return
-        except (urllib.error.ContentTooShortError, urllib.error.HTTPError, urllib.error.URLError):
-            time.sleep(holdoff)
+        except HashMismatch as e:
+            print("{}. Retrying.".format(e))
+            get_metrics().count('download.nar', 'hash_mismatches')
+        except (urllib.error.ContentTooShortError, urllib.error.HTTPError, urllib.error.URLError, ConnectionError, http.client.HTTPException) as e:
+            time.sleep(backoff_delay(x, e))
+        get_metrics().count('download.nar', 'failed_attempts')
     # Only reached if download failed
     raise DownloadFailed("Failed to download {}".format(path))
 
-def fetch_release_info(hydra_url, project, jobset, job):
+def fetch_release_info(hydra_url, project, jobset, job, cache = None):
     url = "{}/job/{}/{}/{}/latest-finished".format(hydra_url, project, jobset, job)
-    return fetch_json(url)
+    return fetch_json(url, cache)
+
+class HashingReader:
+    """Passes reads through and hashes everything that has been read"""
+    def __init__(self, f, file_hash = None):
+        self.f = f
+        self.size = 0
+        if file_hash is not None:
+            self.hash_type, self.hash_value = split_file_hash(file_hash)
+            self.mh = MultiHash([ self.hash_type ])
+        else:
+            self.mh = None
+
+    def read(self, n = -1):
+        data = self.f.read(n if n is not None and n >= 0 else None)
+        self.size += len(data)
+        if self.mh is not None:
+            self.mh.update(data)
+        return data
+
+    def drain(self):
+        while len(self.read(DEFAULT_HASH_CHUNK_SIZE)):
+            pass
 
-def fetch_store_path(path, dest_file, binary_cache = DEFAULT_BINARY_CACHE_URL, tmp_dir=os.getcwd()):
+    def verify(self, name):
+        if self.mh is not None and self.mh.hexdigest(self.hash_type, "base32") != self.hash_value:
+            raise HashMismatch("Hash verification for {} failed".format(name))
+
+def decompress_stream(f, compression):
+    if compression == 'xz':
+        return lzma.open(f)
+    elif compression == 'bzip2':
+        return bz2.open(f)
+    elif compression in [ 'none', '' ]:
+        return f
+    raise NarError("unsupported compression {}".format(compression))
+
+def stream_store_path(url, compression, file_hash, path_in_nar, dest_file):
+    # HTTP body -> decompressor -> NAR reader -> dest_file, the NAR never touches the disk
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dest_file)), prefix='.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            with get_client().request(url) as r:
+                raw = HashingReader(r, file_hash)
+                if not NarReader(decompress_stream(raw, compression)).extract(path_in_nar, out):
+                    raise NarError("{} not found in {}".format(path_in_nar, url))
+                # the rest is only read to verify the FileHash
+                raw.drain()
+                raw.verify(url)
+        os.replace(tmp_path, dest_file)
+    except:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+# tmp_dir is unused since nothing is extracted to disk anymore
+def fetch_store_path(path, dest_file, binary_cache = DEFAULT_BINARY_CACHE_URL, tmp_dir=None, tries = DEFAULT_DOWNLOAD_TRIES, narinfo = None):
     if not path.startswith("/nix/store/"):
         raise Exception("path not valid")
-    ni = NarInfo(fetch_file_from_cache(nar_info_from_path(path)))
-
-    with tempfile.TemporaryDirectory(dir=tmp_dir) as temp_dir:
-        with ccd(temp_dir):
-            nar_location = os.path.join(temp_dir, os.path.basename(ni.d['URL']))
-            download_file_from_cache(ni.d['URL'], nar_location, binary_cache)
-            assert(os.path.isfile(nar_location))
-            if ni.d['Compression'] == 'xz' and nar_location.endswith("xz"):
-                nar_extract_location = ".".join(nar_location.split(".")[:-1])
-                with lzma.open(nar_location) as n:
-                    with open(nar_extract_location, "wb") as ne:
-                        ne.write(n.read())
-            elif ni.d['Compression'] == 'bzip2' and nar_location.endswith("bz2"):
-                nar_extract_location = ".".join(nar_location.split(".")[:-1])
-                with bz2.open(nar_location) as n:
-                    with open(nar_extract_location, "wb") as ne:
-                        ne.write(n.read())
-            else:
-                nar_extract_location = nar_location
-            path_in_nar = '/'.join([''] + path.split('/')[4:])
-            subprocess.run("nix cat-nar {} {} > {}".format(nar_extract_location, path_in_nar, dest_file), shell=True)
-            assert(os.path.isfile(dest_file))
+    ni = narinfo or NarInfo(fetch_file_from_cache(nar_info_from_path(path), binary_cache))
+    url = "{}/{}".format(binary_cache, ni.d['URL'])
+    path_in_nar = '/'.join([''] + path.split('/')[4:])
+
+    for x in range(0, tries):
+        try:
+            stream_store_path(url, ni.d.get('Compression', 'none'), ni.d.get('FileHash'), path_in_nar, dest_file)
+            get_metrics().count('download.store_path', 'files')
+            get_metrics().count('download.store_path', 'bytes', os.path.getsize(dest_file))
+            return
+        except HashMismatch as e:
+            print("{}. Retrying.".format(e))
+        except (urllib.error.ContentTooShortError, urllib.error.HTTPError, urllib.error.URLError,
+                ConnectionError, http.client.HTTPException, lzma.LZMAError, EOFError) as e:
+            time.sleep(backoff_delay(x, e))
+        get_metrics().count('download.store_path', 'failed_attempts')
+    raise DownloadFailed("Failed to download {}".format(path))
 
 class NarInfoCollector:
-    def __init__(self):
+    def __init__(self, on_collect=None):
+        """Without on_collect all narinfos are kept in collection, otherwise
+        on_collect(name, NarInfo, fetched) is called as soon as one is known"""
         self.queue = queue.Queue()
         self.work = set()
         self.work_done = set()
         self.lock = threading.Lock()
         self.collection = []
+        self.collected = 0
+        self.on_collect = on_collect
+
+    def collect(self, name, n, fetched):
+        if self.on_collect is not None:
+            self.on_collect(name, n, fetched)
+        else:
+            self.collection.append([name, n])
+        with self.lock:
+            self.collected += 1
+
+    def preload(self, narinfos):
+        # narinfos that are already known (e.g. from a NarInfoIndex) are not fetched again
+        with self.lock:
+            self.work_done.update(narinfos.keys())
+        for name, text in narinfos.items():
+            self.collect(name, NarInfo(text), False)
+
+    def skip(self, names):
+        # narinfos that are handled elsewhere and must neither be fetched nor collected
+        with self.lock:
+            self.work_done.update(names)
 
     def start(self, store_paths):
         for path in store_paths:
@@ -108,8 +414,8 @@ class NarInfoCollector:
 
     def turn_in(self, name, nar_info):
         n = NarInfo(nar_info)
-        self.collection.append([name, n])
-        nar_infos = [ nar_info_from_path(path) for path in n.d['References'].split(' ') ]
+        self.collect(name, n, True)
+        nar_infos = [ nar_info_from_path(path) for path in n.d.get('References', '').split(' ') ]
 
         with self.lock:
             self.work_done.add(name)
@@ -118,3 +424,9 @@ class NarInfoCollector:
                 if len(n):
                     self.add_work(n)
         self.queue.task_done()
+
+    def give_up(self, name):
+        with self.lock:
+            self.work_done.add(name)
+            self.work.discard(name)
+        self.queue.task_done()
@@ -1,25 +1,113 @@
 #!/usr/bin/env python3
 import os
+import time
+
+from nixipfs.nix_helpers import nar_info_from_path
+from nixipfs.narinfo_index import NarInfoIndex
+from nixipfs.metrics import get_metrics
+from nixipfs.defaults import *
+
+def release_links(release):
+    linked_cache_path = os.path.join(release, 'binary_cache')
+    links = set(
+        [ e for e in os.listdir(linked_cache_path) if '.narinfo' in e ])
+    links.update(set(
+        [ os.path.join('nar', e) for e in os.listdir(os.path.join(linked_cache_path, 'nar')) if '.nar' in e ]))
+    return links
+
+def mark(cache, releases, keep=[]):
+    """Returns the names (relative to cache) of all files that are reachable.
+
+    These are the files every release links to, as recorded in the narinfo
+    index by update_binary_cache. Only releases the index knows nothing about
+    are listed. Store paths in keep are roots whose closures are taken from
+    the index, other entries of keep are names of files."""
+    index_path = os.path.join(os.path.dirname(os.path.abspath(cache)), 'narinfo-index.sqlite')
+    live = set([ k for k in keep if not k.startswith('/nix/store/') ])
+    roots = set([ nar_info_from_path(k) for k in keep if k.startswith('/nix/store/') ])
+    index = NarInfoIndex(index_path) if os.path.isfile(index_path) else None
+    try:
+        for release in releases:
+            links = index.links(release) if index is not None else None
+            if links is None:
+                print("{} is not indexed, marking by its links".format(release))
+                links = release_links(release)
+            live.update(links)
+        if len(roots):
+            if index is None:
+                raise Exception("store paths can only be kept with a narinfo index")
+            urls, missing = index.closure_urls(roots)
+            live.update(urls.keys())
+            live.update(urls.values())
+            if len(missing):
+                print("{} paths to keep are not indexed".format(len(missing)))
+    finally:
+        if index is not None:
+            index.close()
+    return live
+
+def sweep(cache, live):
+    """Yields (directory, [(name, size)]) of files in cache that are not live,
+    at most DEFAULT_GC_BATCH names per batch"""
+    for directory, prefix, pattern in [ (cache, '', '.narinfo'), (os.path.join(cache, 'nar'), 'nar', '.nar') ]:
+        batch = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not pattern in entry.name or not entry.is_file(follow_symlinks=False):
+                    continue
+                name = os.path.join(prefix, entry.name) if len(prefix) else entry.name
+                if name not in live:
+                    batch.append((entry.name, entry.stat(follow_symlinks=False).st_size))
+                    if len(batch) >= DEFAULT_GC_BATCH:
+                        yield directory, batch
+                        batch = []
+        if len(batch):
+            yield directory, batch
 
 def find_garbage(cache, releases, keep=[]):
-    links = set()
-    for release in releases:
-        linked_cache_path = os.path.join(release, 'binary_cache')
-        links.update(set(
-            [ e for e in os.listdir(linked_cache_path) if '.narinfo' in e ]))
-        links.update(set(
-            [ os.path.join('nar', e) for e in os.listdir(os.path.join(linked_cache_path, 'nar')) if '.nar' in e ]))
-
-    files = set()
-    files.update(set(
-        [ e for e in os.listdir(cache) if '.narinfo' in e ]))
-    files.update(set(
-        [ os.path.join('nar', e) for e in os.listdir(os.path.join(cache, 'nar')) if '.nar' in e ]))
-    return files.difference(links)
-
-def garbage_collect(cache, releases, keep=[]):
-    garbage = find_garbage(cache, releases, keep)
-    for g in garbage:
-        if os.path.isfile(os.path.join(cache, g)):
-            print("Deleting {}".format(g))
-            os.unlink(os.path.join(cache, g))
+    garbage = set()
+    for directory, batch in sweep(cache, mark(cache, releases, keep)):
+        prefix = os.path.relpath(directory, cache)
+        garbage.update([ name if prefix == '.' else os.path.join(prefix, name) for name, size in batch ])
+    return garbage
+
+def forget_releases(cache):
+    # links of releases that have been deleted are not needed anymore
+    index_path = os.path.join(os.path.dirname(os.path.abspath(cache)), 'narinfo-index.sqlite')
+    if not os.path.isfile(index_path):
+        return
+    index = NarInfoIndex(index_path)
+    try:
+        index.forget([ r for r in index.releases() if not os.path.isdir(r) ])
+    finally:
+        index.close()
+
+def garbage_collect(cache, releases, keep=[], dry_run=False):
+    with get_metrics().stage('garbage_collect.mark'):
+        live = mark(cache, releases, keep)
+    get_metrics().set('garbage_collect.mark', { 'live' : len(live) })
+    start = time.monotonic()
+    count = 0
+    size = 0
+    for directory, batch in sweep(cache, live):
+        count += len(batch)
+        size += sum([ s for name, s in batch ])
+        if not dry_run:
+            # names are resolved relative to the open directory, not as full paths
+            fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                for name, s in batch:
+                    os.unlink(name, dir_fd=fd)
+            finally:
+                os.close(fd)
+            if len(batch) >= DEFAULT_GC_BATCH:
+                print("Deleted {} files".format(count))
+    if not dry_run:
+        forget_releases(cache)
+    get_metrics().record('garbage_collect.sweep', time.monotonic() - start)
+    get_metrics().add('garbage_collect.sweep', { 'files' : count, 'bytes' : size })
+    if dry_run:
+        print("{} files, {:.1f} MB can be reclaimed".format(count, size / 1e6))
+    else:
+        print("Deleted {} files, reclaimed {:.1f} MB".format(count, size / 1e6))
+    return count, size
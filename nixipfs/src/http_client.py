@@ -0,0 +1,206 @@
+import base64
+import http.client
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from nixipfs.metrics import get_metrics
+from nixipfs.defaults import *
+
+REDIRECT_CODES = [ 301, 302, 303, 307, 308 ]
+MAX_REDIRECTS = 5
+
+# Errors raised by a kept-alive connection that the server has closed in the meantime
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                           BrokenPipeError, ConnectionResetError, ConnectionAbortedError)
+
+class PooledResponse:
+    """Wraps a http.client.HTTPResponse and hands the connection back to its
+    pool once the body has been consumed."""
+    def __init__(self, client, key, conn, resp, url):
+        self.client = client
+        self.key = key
+        self.conn = conn
+        self.resp = resp
+        self.url = url
+        self.status = resp.status
+        self.headers = resp.headers
+
+    def getheader(self, name, default=None):
+        return self.resp.getheader(name, default)
+
+    def read(self, amt=None):
+        try:
+            data = self.resp.read(amt)
+        except (OSError, http.client.HTTPException) as e:
+            self.abort()
+            raise urllib.error.URLError(e)
+        if amt is None or not data:
+            self.close()
+        return data
+
+    def readinto(self, b):
+        try:
+            n = self.resp.readinto(b)
+        except (OSError, http.client.HTTPException) as e:
+            self.abort()
+            raise urllib.error.URLError(e)
+        if not n:
+            self.close()
+        return n
+
+    def abort(self):
+        # a body that failed half way leaves the connection in an unknown state
+        if self.conn is None:
+            return
+        self.client._release(self.key, self.conn, False)
+        self.conn = None
+
+    def close(self):
+        if self.conn is None:
+            return
+        reusable = self.resp.isclosed() and not self.resp.will_close
+        self.client._release(self.key, self.conn, reusable)
+        self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def proxy_auth(proxy):
+    # Proxy-Authorization for a proxy url with user:password@
+    if proxy.username is None:
+        return {}
+    credentials = "{}:{}".format(urllib.parse.unquote(proxy.username), urllib.parse.unquote(proxy.password or ''))
+    return { 'Proxy-Authorization' : 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii') }
+
+class HTTPClient:
+    """A thread-safe HTTP client that keeps persistent connections per host.
+
+    Like urllib it honours http_proxy, https_proxy and no_proxy: http
+    requests are sent to the proxy, https requests are tunneled through it
+    with CONNECT."""
+    def __init__(self, pool_size=DEFAULT_HTTP_POOL_SIZE, timeout=DEFAULT_HTTP_TIMEOUT, proxies=None):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.proxies = urllib.request.getproxies() if proxies is None else proxies
+        self.pools = {}
+        self.lock = threading.Lock()
+        self.counters = { 'requests' : 0, 'connections' : 0, 'reused' : 0, 'redirects' : 0, 'errors' : 0 }
+
+    def _count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def stats(self):
+        with self.lock:
+            res = dict(self.counters)
+            res['idle'] = sum([ len(p) for p in self.pools.values() ])
+        return res
+
+    def summary(self):
+        s = self.stats()
+        return "{} requests over {} connections ({} reused, {} redirects, {} errors)".format(
+            s['requests'], s['connections'], s['reused'], s['redirects'], s['errors'])
+
+    def proxy(self, u):
+        """The proxy (a split url) to use for the split url u, None to connect directly"""
+        proxy = self.proxies.get(u.scheme)
+        if proxy is None or urllib.request.proxy_bypass_environment(u.hostname or '', self.proxies):
+            return None
+        return urllib.parse.urlsplit(proxy if '://' in proxy else 'http://' + proxy)
+
+    def _acquire(self, key):
+        with self.lock:
+            pool = self.pools.get(key)
+            if pool:
+                self.counters['reused'] += 1
+                return pool.pop(), True
+            self.counters['connections'] += 1
+        scheme, netloc, proxy = key
+        if proxy is None:
+            host = netloc
+        else:
+            # http.client speaks plain HTTP to the proxy, https goes through a CONNECT tunnel
+            host = proxy.netloc.rpartition('@')[2]
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, timeout=self.timeout)
+            if proxy is not None:
+                conn.set_tunnel(netloc, headers=proxy_auth(proxy))
+        else:
+            conn = http.client.HTTPConnection(host, timeout=self.timeout)
+        return conn, False
+
+    def _release(self, key, conn, reusable):
+        if reusable:
+            with self.lock:
+                pool = self.pools.setdefault(key, [])
+                if len(pool) < self.pool_size:
+                    pool.append(conn)
+                    return
+        conn.close()
+
+    def _request_once(self, method, url, headers):
+        u = urllib.parse.urlsplit(url)
+        if u.scheme not in [ 'http', 'https' ]:
+            raise urllib.error.URLError("unsupported url scheme: {}".format(url))
+        proxy = self.proxy(u)
+        key = (u.scheme, u.netloc, proxy)
+        target = urllib.parse.urlunsplit(('', '', u.path or '/', u.query, ''))
+        h = { 'User-Agent' : DEFAULT_HTTP_USER_AGENT }
+        if proxy is not None and u.scheme == 'http':
+            # a proxy gets the absolute url
+            target = urllib.parse.urlunsplit((u.scheme, u.netloc, u.path or '/', u.query, ''))
+            h.update(proxy_auth(proxy))
+        h.update(headers)
+
+        # A reused connection may have been closed by the server, retry that once on a new one
+        for attempt in range(2):
+            conn, reused = self._acquire(key)
+            start = time.monotonic()
+            try:
+                conn.request(method, target, headers=h)
+                resp = conn.getresponse()
+                get_metrics().observe('http', time.monotonic() - start)
+                break
+            except STALE_CONNECTION_ERRORS as e:
+                conn.close()
+                get_metrics().count('http', 'retries')
+                if not reused or attempt == 1:
+                    self._count('errors')
+                    raise urllib.error.URLError(e)
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                self._count('errors')
+                raise urllib.error.URLError(e)
+        self._count('requests')
+        return PooledResponse(self, key, conn, resp, url)
+
+    def request(self, url, headers={}, method='GET'):
+        for x in range(MAX_REDIRECTS + 1):
+            resp = self._request_once(method, url, headers)
+            if resp.status in REDIRECT_CODES and resp.getheader('Location') is not None:
+                resp.read()
+                url = urllib.parse.urljoin(url, resp.getheader('Location'))
+                self._count('redirects')
+                continue
+            if resp.status >= 400:
+                body = resp.read()
+                self._count('errors')
+                raise urllib.error.HTTPError(url, resp.status, body.decode('utf8', 'replace')[:200], resp.headers, None)
+            return resp
+        raise urllib.error.URLError("too many redirects: {}".format(url))
+
+    def fetch(self, url, headers={}):
+        with self.request(url, headers) as r:
+            return r.read()
+
+# Shared by all workers of a process
+default_client = HTTPClient()
+
+def get_client():
+    return default_client
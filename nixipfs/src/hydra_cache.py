@@ -0,0 +1,70 @@
+import sqlite3
+import threading
+import time
+import zlib
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS responses (
+           url TEXT PRIMARY KEY,
+           etag TEXT,
+           last_modified TEXT,
+           fetched REAL NOT NULL,
+           body BLOB NOT NULL)'''
+]
+
+class CachedResponse:
+    def __init__(self, etag, last_modified, fetched, body):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = fetched
+        self.body = body
+
+    def validators(self):
+        """Headers that make the next request for this url conditional"""
+        h = {}
+        if self.etag:
+            h['If-None-Match'] = self.etag
+        if self.last_modified:
+            h['If-Modified-Since'] = self.last_modified
+        return h
+
+class ResponseCache:
+    """Bodies of Hydra API responses with their ETag/Last-Modified, keyed by url.
+
+    Responses that can change (latest-finished) are revalidated with a
+    conditional request, evaluations never change once they exist and are
+    answered from the cache without a request."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        for stmt in SCHEMA:
+            self.db.execute(stmt)
+        self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def get(self, url):
+        with self.lock:
+            row = self.db.execute('SELECT etag, last_modified, fetched, body FROM responses WHERE url = ?',
+                                  (url,)).fetchone()
+        if row is None:
+            return None
+        return CachedResponse(row[0], row[1], row[2], zlib.decompress(row[3]))
+
+    def put(self, url, etag, last_modified, body):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                            (url, etag, last_modified, time.time(), zlib.compress(body)))
+            self.db.commit()
+
+    def expire(self, max_age):
+        """Drops responses older than max_age seconds, returns how many"""
+        with self.lock:
+            n = self.db.execute('DELETE FROM responses WHERE fetched < ?', (time.time() - max_age,)).rowcount
+            self.db.commit()
+        return n
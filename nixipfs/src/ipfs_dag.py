@@ -0,0 +1,152 @@
+import base64
+import io
+import struct
+
+from nixipfs.defaults import *
+
+# Builds UnixFS directories (plain and HAMT sharded) locally and submits the
+# finished dag-pb nodes with /object/put, instead of one MFS operation per entry.
+
+HAMT_FANOUT = 256
+HAMT_HASH_TYPE = 0x22 # murmur3-x64-64
+
+UNIXFS_DIRECTORY = 1
+UNIXFS_HAMT_SHARD = 5
+
+B58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+MASK64 = (1 << 64) - 1
+
+def varint(n):
+    res = bytearray()
+    while True:
+        b = n & 0x7f
+        n >>= 7
+        if n:
+            res.append(b | 0x80)
+        else:
+            res.append(b)
+            return bytes(res)
+
+def pb_bytes(field, data):
+    return varint(field << 3 | 2) + varint(len(data)) + data
+
+def pb_varint(field, n):
+    return varint(field << 3) + varint(n)
+
+def b58decode(s):
+    n = 0
+    for c in s:
+        n = n * 58 + B58_ALPHABET.index(c)
+    pad = len(s) - len(s.lstrip('1'))
+    return b'\0' * pad + n.to_bytes((n.bit_length() + 7) // 8, 'big')
+
+def cid_bytes(cid):
+    # CIDv0 is a bare base58 multihash, CIDv1 carries a multibase prefix
+    if cid.startswith('Qm') and len(cid) == 46:
+        return b58decode(cid)
+    elif cid.startswith('b'):
+        s = cid[1:].upper()
+        return base64.b32decode(s + '=' * (-len(s) % 8))
+    elif cid.startswith('z'):
+        return b58decode(cid[1:])
+    raise ValueError("unsupported CID encoding: {}".format(cid))
+
+def _rotl64(x, r):
+    return ((x << r) | (x >> (64 - r))) & MASK64
+
+def _fmix64(k):
+    k ^= k >> 33
+    k = (k * 0xff51afd7ed558ccd) & MASK64
+    k ^= k >> 33
+    k = (k * 0xc4ceb9fe1a85ec53) & MASK64
+    k ^= k >> 33
+    return k
+
+def murmur3_x64_64(data):
+    # First 64 bits of MurmurHash3_x64_128 with seed 0, as used by go-unixfs
+    c1 = 0x87c37b91114253d5
+    c2 = 0x4cf5ad432745937f
+    h1 = h2 = 0
+    nblocks = len(data) // 16
+    for i in range(nblocks):
+        k1, k2 = struct.unpack_from('<QQ', data, i * 16)
+        k1 = _rotl64((k1 * c1) & MASK64, 31)
+        h1 ^= (k1 * c2) & MASK64
+        h1 = (_rotl64(h1, 27) + h2) & MASK64
+        h1 = (h1 * 5 + 0x52dce729) & MASK64
+        k2 = _rotl64((k2 * c2) & MASK64, 33)
+        h2 ^= (k2 * c1) & MASK64
+        h2 = (_rotl64(h2, 31) + h1) & MASK64
+        h2 = (h2 * 5 + 0x38495ab5) & MASK64
+    tail = data[nblocks * 16:]
+    if len(tail) > 8:
+        k2 = _rotl64((int.from_bytes(tail[8:], 'little') * c2) & MASK64, 33)
+        h2 ^= (k2 * c1) & MASK64
+    if len(tail) > 0:
+        k1 = _rotl64((int.from_bytes(tail[:8], 'little') * c1) & MASK64, 31)
+        h1 ^= (k1 * c2) & MASK64
+    h1 ^= len(data)
+    h2 ^= len(data)
+    h1 = (h1 + h2) & MASK64
+    h2 = (h2 + h1) & MASK64
+    h1 = _fmix64(h1)
+    h2 = _fmix64(h2)
+    return (h1 + h2) & MASK64
+
+def unixfs_data(data_type, data=None):
+    res = pb_varint(1, data_type)
+    if data is not None:
+        res += pb_bytes(2, data)
+    if data_type == UNIXFS_HAMT_SHARD:
+        res += pb_varint(5, HAMT_HASH_TYPE) + pb_varint(6, HAMT_FANOUT)
+    return res
+
+def encode_node(data, links):
+    """Serializes a dag-pb node, links is a list of (name, cid, tsize)"""
+    res = b''
+    for name, cid, tsize in sorted(links, key=lambda l: l[0].encode('utf-8')):
+        link = pb_bytes(1, cid_bytes(cid)) + pb_bytes(2, name.encode('utf-8')) + pb_varint(3, tsize)
+        res += pb_bytes(2, link)
+    return res + pb_bytes(1, data)
+
+class DagBuilder:
+    def __init__(self, api, shard_threshold=DEFAULT_HAMT_THRESHOLD):
+        self.api = api
+        self.shard_threshold = shard_threshold
+        self.puts = 0
+
+    def put_node(self, data, links):
+        """Returns (cid, cumulative size) of the stored node"""
+        node = encode_node(data, links)
+        res = self.api.object_put(io.BytesIO(node), opts={'inputenc': 'protobuf'})
+        self.puts += 1
+        return res['Hash'], len(node) + sum([ l[2] for l in links ])
+
+    def directory(self, entries):
+        """entries maps names to (cid, cumulative size), returns (cid, cumulative size)"""
+        # Same criterion as go-ipfs: shard once the links would exceed the block size estimate
+        estimate = sum([ len(name) + len(cid_bytes(cid)) for name, (cid, size) in entries.items() ])
+        if estimate <= self.shard_threshold:
+            return self.put_node(unixfs_data(UNIXFS_DIRECTORY),
+                                 [ (name, cid, size) for name, (cid, size) in entries.items() ])
+        items = [ (name, cid, size, murmur3_x64_64(name.encode('utf-8')).to_bytes(8, 'big'))
+                  for name, (cid, size) in entries.items() ]
+        return self._shard(items, 0)
+
+    def _shard(self, items, depth):
+        buckets = {}
+        for item in items:
+            buckets.setdefault(item[3][depth], []).append(item)
+        bitfield = 0
+        links = []
+        for idx, bucket in buckets.items():
+            bitfield |= 1 << idx
+            if len(bucket) == 1:
+                name, cid, size, _ = bucket[0]
+                links.append(("{:02X}{}".format(idx, name), cid, size))
+            else:
+                cid, size = self._shard(bucket, depth + 1)
+                links.append(("{:02X}".format(idx), cid, size))
+        bitfield_bytes = bitfield.to_bytes((bitfield.bit_length() + 7) // 8, 'big')
+        return self.put_node(unixfs_data(UNIXFS_HAMT_SHARD, bitfield_bytes), links)
@@ -0,0 +1,78 @@
+import os
+import sqlite3
+import threading
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS files (
+           path TEXT PRIMARY KEY,
+           size INTEGER NOT NULL,
+           mtime INTEGER NOT NULL,
+           inode INTEGER NOT NULL,
+           hash TEXT NOT NULL)''',
+    '''CREATE TABLE IF NOT EXISTS dirs (
+           path TEXT PRIMARY KEY,
+           fingerprint TEXT NOT NULL,
+           hash TEXT NOT NULL)'''
+]
+
+def file_identity(path):
+    # Symlinks are resolved, so a release link and the file in the global
+    # cache share one entry
+    st = os.stat(path)
+    return os.path.realpath(path), st.st_size, st.st_mtime_ns, st.st_ino
+
+class IPFSHashCache:
+    """Maps local files to the IPFS hash they were added as.
+
+    Entries are keyed by (path, size, mtime, inode), a file that has been
+    modified or replaced no longer matches and is added again."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        for stmt in SCHEMA:
+            self.db.execute(stmt)
+        self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def get(self, path):
+        if not os.path.exists(path):
+            return None
+        with self.lock:
+            row = self.db.execute('SELECT hash FROM files WHERE path = ? AND size = ? AND mtime = ? AND inode = ?',
+                                  file_identity(path)).fetchone()
+        return row[0] if row is not None else None
+
+    def __getitem__(self, path):
+        res = self.get(path)
+        if res is None:
+            raise KeyError(path)
+        return res
+
+    def update(self, hashes):
+        """hashes maps local paths to IPFS hashes"""
+        rows = [ file_identity(path) + (h,) for path, h in hashes.items() ]
+        with self.lock:
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', rows)
+
+    def get_dir(self, path, fingerprint):
+        with self.lock:
+            row = self.db.execute('SELECT hash FROM dirs WHERE path = ? AND fingerprint = ?',
+                                  (os.path.realpath(path), fingerprint)).fetchone()
+        return row[0] if row is not None else None
+
+    def update_dir(self, path, fingerprint, h):
+        with self.lock:
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)',
+                                (os.path.realpath(path), fingerprint, h))
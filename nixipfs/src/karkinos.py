@@ -2,19 +2,23 @@ import urllib.request
 import json
 import os
 
-from nixipfs.download_helpers import fetch_json, fetch_store_path
+from nixipfs.download_helpers import fetch_json, fetch_store_path, fetch_file_from_cache
+from nixipfs.nix_helpers import NarInfo, nar_info_from_path
 from nixipfs.hydra_helpers import *
+from nixipfs.concurrency import DiskBudget
+from nixipfs.pipeline import Pipeline, Stage
 from nixipfs.defaults import *
 
 class KarkinosURLopener(urllib.request.FancyURLopener):
     version = "Karkinos/11.11"
 
 class Karkinos:
-    def __init__(self, hydra_url, eval_id, binary_cache = DEFAULT_BINARY_CACHE_URL):
+    def __init__(self, hydra_url, eval_id, binary_cache = DEFAULT_BINARY_CACHE_URL, response_cache = None):
         urllib._urlopener = KarkinosURLopener()
         self.hydra_url = hydra_url
         self.binary_cache = binary_cache
         self.eval_id   = eval_id
+        self.response_cache = response_cache
 
     @property
     def eval_url(self):
@@ -27,21 +31,55 @@ class Karkinos:
     def build_info_url(self, jobname):
         return "{}/job/{}".format(self.eval_url, jobname)
 
+    # An evaluation and its builds do not change anymore once it is finished
     def fetch_eval_info(self):
-        return fetch_json(self.eval_url)
+        return fetch_json(self.eval_url, self.response_cache, immutable=True)
 
     def fetch_store_paths(self):
-        return fetch_json(self.store_path_url)
+        return fetch_json(self.store_path_url, self.response_cache, immutable=True)
 
     def fetch_build_info(self, jobname):
-        return fetch_json(self.build_info_url(jobname))
+        return fetch_json(self.build_info_url(jobname), self.response_cache, immutable=True)
 
-    def download_file(self, jobname, dest_dir, dest_name='', tmp_dir=os.getcwd()):
+    def resolve_file(self, jobname, dest_dir, dest_name=''):
+        """Returns (build product path, destination, NarInfo of its store path),
+        the NarInfo is None if the destination exists already"""
         build_info = BuildInfo(self.fetch_build_info(jobname))
         store_path = "/".join(build_info.path.split("/")[:4])
 
         if len(dest_name) == 0:
             dest_name = os.path.basename(build_info.path)
         dest_file = os.path.join(dest_dir, dest_name)
-        if not os.path.isfile(dest_file):
-            fetch_store_path(build_info.path, dest_file, self.binary_cache, tmp_dir)
+        if os.path.isfile(dest_file):
+            return build_info.path, dest_file, None
+        narinfo = NarInfo(fetch_file_from_cache(nar_info_from_path(store_path), self.binary_cache))
+        return build_info.path, dest_file, narinfo
+
+    def download_file(self, jobname, dest_dir, dest_name='', tmp_dir=os.getcwd()):
+        path, dest_file, narinfo = self.resolve_file(jobname, dest_dir, dest_name)
+        if narinfo is not None:
+            fetch_store_path(path, dest_file, self.binary_cache, tmp_dir, narinfo=narinfo)
+
+    def download_files(self, files, dest_dir, tmp_dir=os.getcwd(), workers=DEFAULT_ARTIFACT_DOWNLOADS,
+                       budget=DEFAULT_ARTIFACT_DISK_BUDGET):
+        """Downloads the build products of [(jobname, dest_name)] concurrently.
+
+        While a download is running its NarSize is reserved from budget (bytes),
+        so the partial files never take more than that on disk.
+        Returns [(jobname, exception)] of the failed downloads."""
+        disk = DiskBudget(budget)
+
+        def resolve(f, value):
+            return self.resolve_file(f[0], dest_dir, f[1])
+
+        def download(f, value):
+            path, dest_file, narinfo = value
+            if narinfo is None:
+                return dest_file
+            with disk.reserve(int(narinfo.d.get('NarSize', 0))):
+                fetch_store_path(path, dest_file, self.binary_cache, tmp_dir, narinfo=narinfo)
+            return dest_file
+
+        _, failures = Pipeline([ Stage("resolve", resolve, workers),
+                                 Stage("download", download, workers) ]).run(files)
+        return [ (f[0], e) for f, stage, e in failures ]
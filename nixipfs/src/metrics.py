@@ -0,0 +1,133 @@
+import bisect
+import contextlib
+import json
+import os
+import threading
+import time
+
+LATENCY_BUCKETS = [ 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60 ]
+
+PROMETHEUS_PREFIX = "nixipfs"
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [ 0 ] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """[(upper bound, observations <= bound)], the last bound is +Inf"""
+        res = []
+        total = 0
+        for bound, n in zip(self.buckets + [ float('inf') ], self.counts):
+            total += n
+            res.append((bound, total))
+        return res
+
+    def to_dict(self):
+        return { 'buckets' : { str(b) : n for b, n in self.cumulative() },
+                 'sum' : self.sum,
+                 'count' : self.count }
+
+class Metrics:
+    """Wall time, counters and latency histograms of all stages of a run.
+
+    Stages are named "<module>.<stage>", counters (bytes, files, requests,
+    retries, ...) are kept per stage name."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.histograms = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - start)
+
+    def record(self, name, seconds):
+        with self.lock:
+            s = self.stages.setdefault(name, { 'seconds' : 0.0, 'runs' : 0 })
+            s['seconds'] += seconds
+            s['runs'] += 1
+
+    def count(self, name, key, n=1):
+        with self.lock:
+            c = self.counters.setdefault(name, {})
+            c[key] = c.get(key, 0) + n
+
+    def add(self, name, values):
+        for key, n in values.items():
+            self.count(name, key, n)
+
+    def set(self, name, values):
+        with self.lock:
+            self.counters.setdefault(name, {}).update(values)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.histograms.setdefault(name, Histogram()).observe(seconds)
+
+    def report(self):
+        with self.lock:
+            stages = {}
+            for name in set(self.stages.keys()) | set(self.counters.keys()):
+                stages[name] = dict(self.stages.get(name, {}))
+                stages[name].update(self.counters.get(name, {}))
+            return { 'started' : self.started,
+                     'finished' : time.time(),
+                     'stages' : stages,
+                     'latency' : { name : h.to_dict() for name, h in self.histograms.items() } }
+
+    def write_json(self, path):
+        atomic_write(path, json.dumps(self.report(), indent=2, sort_keys=True))
+
+    def write_prometheus(self, path):
+        """Writes the report in the Prometheus text format, for the node_exporter textfile collector"""
+        r = self.report()
+        lines = []
+        values = {}
+        for name, stage in r['stages'].items():
+            for key, value in stage.items():
+                values.setdefault(key, []).append((name, value))
+        for key in sorted(values.keys()):
+            metric = "{}_stage_{}".format(PROMETHEUS_PREFIX, key)
+            lines.append("# TYPE {} gauge".format(metric))
+            for name, value in sorted(values[key]):
+                lines.append('{}{{stage="{}"}} {}'.format(metric, name, value))
+        metric = "{}_latency_seconds".format(PROMETHEUS_PREFIX)
+        if len(self.histograms):
+            lines.append("# TYPE {} histogram".format(metric))
+        with self.lock:
+            for name, h in sorted(self.histograms.items()):
+                for bound, n in h.cumulative():
+                    le = "+Inf" if bound == float('inf') else str(bound)
+                    lines.append('{}_bucket{{name="{}",le="{}"}} {}'.format(metric, name, le, n))
+                lines.append('{}_sum{{name="{}"}} {}'.format(metric, name, h.sum))
+                lines.append('{}_count{{name="{}"}} {}'.format(metric, name, h.count))
+        metric = "{}_last_run_timestamp_seconds".format(PROMETHEUS_PREFIX)
+        lines.append("# TYPE {} gauge".format(metric))
+        lines.append("{} {}".format(metric, int(r['finished'])))
+        atomic_write(path, "\n".join(lines) + "\n")
+
+def atomic_write(path, text):
+    # readers (e.g. the textfile collector) never see a partially written file
+    with open(path + ".part", "w") as f:
+        f.write(text)
+    os.replace(path + ".part", path)
+
+# Shared by all modules of a process
+metrics = Metrics()
+
+def get_metrics():
+    return metrics
@@ -0,0 +1,61 @@
+import os
+import sqlite3
+import threading
+
+HASH_DIRS = [ "md5", "sha1", "sha256", "sha512" ]
+
+class MirrorIndex:
+    """All hashes that are present in a tarball mirror.
+
+    Names are not recorded, unrelated tarballs share names like
+    v1.0.tar.gz. The keys are loaded into memory once, lookups do not touch
+    the disk. The index can be rebuilt from the md5/sha1/sha256/sha512 trees."""
+    def __init__(self, target_dir, rebuild=False):
+        self.target_dir = target_dir
+        path = os.path.join(target_dir, 'mirror-index.sqlite')
+        rebuild = rebuild or not os.path.isfile(path)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS entries (
+                               key TEXT NOT NULL,
+                               kind TEXT NOT NULL,
+                               PRIMARY KEY (key, kind)) WITHOUT ROWID''')
+        # indexes of older versions also contain the by-name entries
+        self.db.execute("DELETE FROM entries WHERE kind = 'by-name'")
+        self.db.commit()
+        if rebuild:
+            self.rebuild()
+        self.keys = set([ row[0] for row in self.db.execute('SELECT key FROM entries') ])
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def add(self, entries):
+        """entries is a list of (kind, key), they are committed in one transaction"""
+        with self.lock:
+            with self.db:
+                self.db.executemany('INSERT OR IGNORE INTO entries VALUES (?, ?)',
+                                    [ (key, kind) for kind, key in entries ])
+            self.keys.update([ key for kind, key in entries ])
+
+    def rebuild(self):
+        entries = []
+        for kind in HASH_DIRS:
+            directory = os.path.join(self.target_dir, kind)
+            if os.path.isdir(directory):
+                with os.scandir(directory) as it:
+                    entries += [ (kind, e.name) for e in it if not e.name.startswith('.') ]
+        with self.lock:
+            with self.db:
+                self.db.execute('DELETE FROM entries')
+                self.db.executemany('INSERT OR IGNORE INTO entries VALUES (?, ?)',
+                                    [ (key, kind) for kind, key in entries ])
+        print("rebuilt mirror index with {} entries".format(len(entries)))
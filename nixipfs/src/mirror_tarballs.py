@@ -1,19 +1,27 @@
 import json
+import lzma
 import urllib.request
 import os
 import queue
-import tempfile
 import subprocess
 import threading
 import shlex
+import shutil
+import tarfile
 import hashlib
 import time
-from pygit2 import clone_repository, GIT_RESET_HARD, Repository
+import fcntl
+import traceback
+import http.client
+import urllib.error
 from shutil import copyfile
+from glob import glob
 
-from nixipfs.download_helpers import DownloadFailed
-from nixipfs.nix_helpers import nix_hash
-from nixipfs.utils       import ccd
+from nixipfs.download_helpers import DownloadFailed, stream_url_to_file, partial_paths
+from nixipfs.nix_helpers import nix_hashes, MultiHash
+from nixipfs.mirror_index import MirrorIndex
+from nixipfs.metrics import get_metrics
+from nixipfs.concurrency import backoff_delay
 from nixipfs.defaults    import *
 
 # For testing purposes:
@@ -23,13 +31,148 @@ MAIN_ALGO = "sha512"
 MAIN_BASE = "base16"
 
 VALID_URL_SCHEMES = [ "http:", "https:", "ftp:", "mirror:" ]
+# everything else (mirror://, ftp://) is fetched by nix-prefetch-url
+DIRECT_URL_SCHEMES = [ "http:", "https:" ]
+
+# from linux/fs.h
+FICLONE = 0x40049409
 
 failed_entries_l = threading.Lock()
-failed_entries = []
+
+store_paths_l = threading.Lock()
+store_paths = []
+
+incoming_l = threading.Condition()
+incoming = set()
+
+# the source cache is shared by all revisions that are mirrored at the same time
+sources_l = threading.Lock()
 
 def nix_instantiate_cmd(expr):
     return "nix-instantiate --eval --json --strict maintainers/scripts/find-tarballs.nix --arg expr '{}'".format(expr)
 
+def source_is_complete(tree):
+    return os.path.isfile(os.path.join(tree, "maintainers", "scripts", "find-tarballs.nix"))
+
+def extract_source_tarball(tarball, dest):
+    # channel tarballs contain the nixpkgs tree in a single top level directory
+    with tarfile.open(tarball) as tar:
+        tar.extractall(dest)
+    top = os.listdir(dest)
+    if len(top) != 1:
+        return None
+    return os.path.join(dest, top[0])
+
+def shallow_fetch(git_repo, revision, dest):
+    # only the tree of a single commit is transferred, no history
+    os.makedirs(dest)
+    for cmd in [ "git init -q",
+                 "git fetch -q --depth 1 {} {}".format(shlex.quote(git_repo), shlex.quote(revision)),
+                 "git checkout -q FETCH_HEAD" ]:
+        subprocess.run(cmd, shell=True, cwd=dest, check=True)
+    shutil.rmtree(os.path.join(dest, ".git"))
+    return dest
+
+def evict_sources(cache_dir, keep):
+    trees = [ e for e in os.scandir(cache_dir) if e.is_dir() and not e.name.endswith(".part") ]
+    trees.sort(key=lambda e: e.stat().st_mtime)
+    for tree in trees[:-keep]:
+        print("Evicting nixpkgs source {}".format(tree.name))
+        shutil.rmtree(tree.path)
+
+def fetch_source(tmp_dir, git_repo, revision, source_tarball=None, keep=DEFAULT_SOURCE_CACHE_SIZE):
+    """Returns the path of the nixpkgs tree of revision, the last keep trees are cached"""
+    cache_dir = os.path.join(tmp_dir, "nixpkgs-sources")
+    os.makedirs(cache_dir, exist_ok=True)
+    tree = os.path.join(cache_dir, revision)
+    if os.path.isdir(tree):
+        # the mtime of a tree is its last use
+        os.utime(tree)
+        return tree
+    partial = tree + ".part"
+    if os.path.exists(partial):
+        shutil.rmtree(partial)
+    if source_tarball is not None and os.path.isfile(source_tarball):
+        root = extract_source_tarball(source_tarball, partial)
+        if root is not None and source_is_complete(root):
+            os.replace(root, tree)
+        else:
+            print("{} does not contain a usable nixpkgs tree".format(source_tarball))
+        shutil.rmtree(partial)
+    if not os.path.isdir(tree):
+        try:
+            os.replace(shallow_fetch(git_repo, revision, partial), tree)
+        except subprocess.CalledProcessError:
+            shutil.rmtree(partial, ignore_errors=True)
+            return None
+    evict_sources(cache_dir, keep)
+    return tree
+
+def eval_cache_path(target_dir, revision, expr):
+    # the evaluation result only depends on the nixpkgs revision and the expression
+    key = hashlib.sha256(expr.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(target_dir, "revisions", revision, "tarballs-{}.json.xz".format(key))
+
+def load_eval_cache(path):
+    with lzma.open(path, "rt") as f:
+        return json.load(f)
+
+def store_eval_cache(path, output):
+    with lzma.open(path + ".part", "wt") as f:
+        json.dump(output, f)
+    os.replace(path + ".part", path)
+
+def cached_find_tarballs(target_dir, revision):
+    for expr in NIX_EXPRS:
+        path = eval_cache_path(target_dir, revision, expr)
+        if os.path.isfile(path):
+            return expr, load_eval_cache(path)
+    return None, None
+
+def find_tarballs(workdir, target_dir, revision):
+    env = os.environ.copy()
+    env["NIX_PATH"] = "nixpkgs={}".format(workdir)
+    for expr in NIX_EXPRS:
+        res = subprocess.run(nix_instantiate_cmd(expr), shell=True, stdout=subprocess.PIPE, env=env, cwd=workdir)
+        if res.returncode != 0:
+            print("nix instantiate failed!")
+        else:
+            output = json.loads(res.stdout.decode('utf-8').strip())
+            store_eval_cache(eval_cache_path(target_dir, revision, expr), output)
+            return expr, output
+    return None, None
+
+def find_previous_revision(target_dir, revision, expr):
+    # Only revisions whose mirror run completed know which of their entries failed
+    revisions_dir = os.path.join(target_dir, "revisions")
+    candidates = []
+    for rev in os.listdir(revisions_dir):
+        path = eval_cache_path(target_dir, rev, expr)
+        if rev != revision and os.path.isfile(path) and os.path.isfile(os.path.join(revisions_dir, rev, "failed.json")):
+            candidates.append((os.path.getmtime(path), rev))
+    return max(candidates)[1] if len(candidates) else None
+
+def new_entries(target_dir, output, previous, expr):
+    """Entries of output that were not mirrored successfully for the previous revision"""
+    key = lambda e: (e['url'], e['hash'])
+    with open(os.path.join(target_dir, "revisions", previous, "failed.json"), "r") as f:
+        failed = set(map(key, json.load(f)))
+    done = set(map(key, load_eval_cache(eval_cache_path(target_dir, previous, expr)))) - failed
+    return [ entry for entry in output if key(entry) not in done ]
+
+def staging_dir(target_dir):
+    # Downloads are staged next to the mirror so nothing incomplete is ever
+    # published, being on the same filesystem keeps the move into sha512/ atomic
+    target_dir = os.path.abspath(target_dir)
+    return os.path.join(os.path.dirname(target_dir), ".{}-staging".format(os.path.basename(target_dir)))
+
+def remove_legacy_partials(target_dir):
+    # earlier versions kept their partial downloads in sha512/
+    sha512_path = os.path.join(target_dir, "sha512")
+    shutil.rmtree(os.path.join(sha512_path, ".partial"), ignore_errors=True)
+    for path in glob(os.path.join(sha512_path, ".incoming-*")):
+        os.unlink(path)
+
 def create_mirror_dirs(target_dir, revision):
     md5_path = os.path.join(target_dir, "md5")
     sha1_path = os.path.join(target_dir, "sha1")
@@ -43,31 +186,46 @@ def create_mirror_dirs(target_dir, revision):
     os.makedirs(sha512_path, exist_ok=True)
     os.makedirs(name_path, exist_ok=True)
     os.makedirs(revision_path, exist_ok=True)
+    os.makedirs(staging_dir(target_dir), exist_ok=True)
+    if os.stat(staging_dir(target_dir)).st_dev != os.stat(target_dir).st_dev:
+        raise Exception("{} and {} must be on the same filesystem".format(staging_dir(target_dir), target_dir))
+    remove_legacy_partials(target_dir)
+
+def link_or_copy(src, dest):
+    # hardlink if possible, otherwise try a reflink (btrfs, xfs) before doing a full copy
+    if os.path.exists(dest):
+        os.unlink(dest)
+    try:
+        os.link(src, dest)
+        return
+    except OSError:
+        pass
+    try:
+        with open(src, 'rb') as s, open(dest, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return
+    except OSError:
+        pass
+    copyfile(src, dest)
 
-def check_presence(target_dir, value):
-    paths = [
-        os.path.join(target_dir, "md5", value),
-        os.path.join(target_dir, "sha1", value),
-        os.path.join(target_dir, "sha256", value),
-        os.path.join(target_dir, "sha512", value),
-        # TODO: glob this
-        os.path.join(target_dir, "by-name", value)
-    ]
-    return [ path for path in paths if os.path.exists(path) ]
-
-def mirror_file(target_dir, path, name, revision):
+def mirror_file(target_dir, path, name, revision, hashes=None, move=False, index=None):
     make_path = lambda x: os.path.join(target_dir, x)
 
-    md5_16 = nix_hash(path, hash_type="md5", base="base16")
-    sha1_16 = nix_hash(path, hash_type="sha1", base="base16")
-    sha256_16 = nix_hash(path, hash_type="sha256", base="base16")
-    sha256_32 = nix_hash(path, hash_type="sha256", base="base32")
-    sha512_16 = nix_hash(path, hash_type="sha512", base="base16")
-    sha512_32 = nix_hash(path, hash_type="sha512", base="base32")
+    if hashes is None:
+        hashes = nix_hashes(path)
+    md5_16 = hashes.hexdigest("md5", "base16")
+    sha1_16 = hashes.hexdigest("sha1", "base16")
+    sha256_16 = hashes.hexdigest("sha256", "base16")
+    sha256_32 = hashes.hexdigest("sha256", "base32")
+    sha512_16 = hashes.hexdigest("sha512", "base16")
+    sha512_32 = hashes.hexdigest("sha512", "base32")
 
     main_file = make_path("sha512/{}".format(sha512_16))
 
-    copyfile(path, main_file)
+    if move:
+        os.replace(path, main_file)
+    else:
+        link_or_copy(path, main_file)
     md5_dir = os.path.join(target_dir, "md5")
     if not os.path.exists(os.path.join(md5_dir, md5_16)):
         os.symlink(os.path.relpath(main_file, start=md5_dir), os.path.join(md5_dir, md5_16))
@@ -97,35 +255,95 @@ def mirror_file(target_dir, path, name, revision):
     if not os.path.exists(os.path.join(revision_dir, sha512_16)):
         os.symlink(os.path.relpath(main_file, start=revision_dir), os.path.join(revision_dir, sha512_16))
 
-def download_worker(target_dir, revision, git_workdir):
-    global download_queue
-    count=0
-    paths=[]
+    # only recorded once all links exist, an interrupted run leaves the index untouched
+    if index is not None:
+        index.add([ ("md5", md5_16), ("sha1", sha1_16), ("sha256", sha256_16), ("sha256", sha256_32),
+                    ("sha512", sha512_16), ("sha512", sha512_32) ])
+
+def download_worker(download_queue, failed_entries, target_dir, revision, git_workdir, index=None):
     while True:
         work = download_queue.get()
         if work is None:
             break
         try:
-            res = nix_prefetch_url(work['url'], work['hash'], git_workdir, work['type'])
-            mirror_file(target_dir, res['path'], work['name'], revision)
-            paths.append(res['path'])
-            count+=1
-            if (count % 42 == 0):
-                for path in paths:
-                    nix_store_delete(path)
-                count=0
-                paths = []
+            # a release that is mirrored at the same time may have fetched it
+            if index is not None and work['hash'] in index:
+                print("url {} already mirrored".format(work['url']))
+                continue
+            direct = len([ x for x in DIRECT_URL_SCHEMES if work['url'].startswith(x) ]) == 1
+            res = None
+            if direct:
+                try:
+                    res = fetch_url(work['url'], target_dir, work['hash'], work['type'])
+                except DownloadFailed:
+                    print("direct download of {} failed, trying nix-prefetch-url".format(work['url']))
+            if res is not None:
+                get_metrics().count('mirror_tarballs.download', 'bytes', os.path.getsize(res['path']))
+                mirror_file(target_dir, res['path'], work['name'], revision, hashes=res['hashes'], move=True, index=index)
+            else:
+                res = nix_prefetch_url(work['url'], work['hash'], git_workdir, work['type'])
+                get_metrics().count('mirror_tarballs.download', 'bytes', os.path.getsize(res['path']))
+                get_metrics().count('mirror_tarballs.download', 'prefetched')
+                mirror_file(target_dir, res['path'], work['name'], revision, index=index)
+                queue_store_delete(res['path'])
+                if direct:
+                    discard_partial(incoming_path(target_dir, work['hash'], work['type']))
+            get_metrics().count('mirror_tarballs.download', 'files')
         except DownloadFailed:
-            append_failed_entry(work)
-        download_queue.task_done()
-    for path in paths:
-        nix_store_delete(path)
+            append_failed_entry(failed_entries, work)
+            get_metrics().count('mirror_tarballs.download', 'failed')
+        except Exception:
+            traceback.print_exc()
+            append_failed_entry(failed_entries, work)
+            get_metrics().count('mirror_tarballs.download', 'failed')
+        finally:
+            download_queue.task_done()
 
-def append_failed_entry(entry):
+def append_failed_entry(failed_entries, entry):
     failed_entries_l.acquire()
     failed_entries.append(entry)
     failed_entries_l.release()
 
+def incoming_path(target_dir, hashv, hash_type):
+    # The name only depends on the expected hash, an interrupted download is
+    # continued by the next run from its partial file in the staging directory
+    return os.path.join(staging_dir(target_dir), "{}-{}".format(hash_type, hashv.replace('/', '_')))
+
+def discard_partial(path):
+    # what is left of a direct download that nix-prefetch-url has completed instead
+    for p in partial_paths(path):
+        if os.path.exists(p):
+            os.unlink(p)
+
+def fetch_url(url, target_dir, hashv, hash_type="sha256", tries=DEFAULT_DOWNLOAD_TRIES):
+    assert(hash_type in [ "md5", "sha1", "sha256", "sha512" ])
+    path = incoming_path(target_dir, hashv, hash_type)
+    # Two entries with the same hash must not write to the same partial file
+    with incoming_l:
+        while path in incoming:
+            incoming_l.wait()
+        incoming.add(path)
+    try:
+        for x in range(0, tries):
+            # All digests that mirror_file needs are computed while downloading
+            hashes = MultiHash()
+            try:
+                stream_url_to_file(url, path, hasher=hashes)
+            except (urllib.error.ContentTooShortError, urllib.error.HTTPError, urllib.error.URLError,
+                    ConnectionError, http.client.HTTPException) as e:
+                time.sleep(backoff_delay(x, e))
+                continue
+            if hashes.matches(hash_type, hashv):
+                return { 'path' : path, 'hashes' : hashes }
+            print("Hash verification for {} failed.".format(url))
+            os.unlink(path)
+            break
+        raise DownloadFailed
+    finally:
+        with incoming_l:
+            incoming.discard(path)
+            incoming_l.notify_all()
+
 def nix_prefetch_url(url, hashv, git_workdir, hash_type="sha256"):
     assert(hash_type in [ "md5", "sha1", "sha256", "sha512" ])
     # For some reason, nix-prefetch-url stalls, the timeout kills the process
@@ -145,60 +363,82 @@ def nix_prefetch_url(url, hashv, git_workdir, hash_type="sha256"):
     r['path'] = lines[1].strip()
     return r
 
-def nix_store_delete(path):
-    res = subprocess.run("nix-store --delete {}".format(path), shell=True, stdout=subprocess.PIPE)
+def nix_store_delete(paths):
+    if not len(paths):
+        return 0
+    res = subprocess.run("nix-store --delete {}".format(" ".join([ shlex.quote(p) for p in paths ])), shell=True, stdout=subprocess.PIPE)
+    if res.returncode != 0 and len(paths) > 1:
+        # nix-store refuses the whole batch if a single path is still alive
+        for path in paths:
+            nix_store_delete([ path ])
     return res.returncode
 
-def mirror_tarballs(target_dir, tmp_dir, git_repo, git_revision, concurrent=DEFAULT_CONCURRENT_DOWNLOADS):
-    global failed_entries
-    global download_queue
+def queue_store_delete(path):
+    # fetched store paths are deleted in batches with a single nix-store call
+    global store_paths
+    with store_paths_l:
+        store_paths.append(path)
+        if len(store_paths) < DEFAULT_STORE_DELETE_BATCH:
+            return
+        paths = store_paths
+        store_paths = []
+    nix_store_delete(paths)
+
+def flush_store_delete():
+    global store_paths
+    with store_paths_l:
+        paths = store_paths
+        store_paths = []
+    nix_store_delete(paths)
+
+def mirror_tarballs(target_dir, tmp_dir, git_repo, git_revision, concurrent=DEFAULT_CONCURRENT_DOWNLOADS, rebuild_index=False, source_tarball=None, index=None):
+    """index is the MirrorIndex of target_dir, revisions that are mirrored at
+    the same time must share it. If it is None it is opened here."""
     create_mirror_dirs(target_dir, git_revision)
+    own_index = index is None
+    if own_index:
+        index = MirrorIndex(target_dir, rebuild=rebuild_index)
+    try:
+        return mirror_revision(target_dir, tmp_dir, git_repo, git_revision, concurrent, source_tarball, index)
+    finally:
+        if own_index:
+            index.close()
+
+def mirror_revision(target_dir, tmp_dir, git_repo, git_revision, concurrent, source_tarball, index):
+    failed_entries = []
     download_queue = queue.Queue()
     threads = []
-    repo_path = os.path.join(tmp_dir, "nixpkgs")
-    os.makedirs(repo_path, exist_ok=True)
-    with ccd(repo_path):
-        exists = False
-        try:
-            repo = Repository(os.path.join(repo_path, ".git"))
-            repo.remotes["origin"].fetch()
-            exists = True
-        except:
-            pass
-        if not exists:
-            repo = clone_repository(git_repo, repo_path)
-        repo.reset(git_revision, GIT_RESET_HARD)
-        with ccd(repo.workdir):
-            success = False
-            env = os.environ.copy()
-            env["NIX_PATH"] = "nixpkgs={}".format(repo.workdir)
-            for expr in NIX_EXPRS:
-              res = subprocess.run(nix_instantiate_cmd(expr), shell=True, stdout=subprocess.PIPE, env=env)
-              if res.returncode != 0:
-                  print("nix instantiate failed!")
-              else:
-                  success = True
-                  break
-            if success is False:
-                return "fatal: all nix instantiate processes failed!"
-            output = json.loads(res.stdout.decode('utf-8').strip())
-    #    with open(os.path.join(target_dir, "tars.json"), "w") as f:
-    #        f.write(json.dumps(output))
-    #with open(os.path.join(target_dir, "tars.json"), "r") as f:
-    #    output = json.loads(f.read())
+    expr, output = cached_find_tarballs(target_dir, git_revision)
+    # nix-prefetch-url resolves mirror:// urls with the source tree, it is needed in any case
+    with sources_l, get_metrics().stage('mirror_tarballs.source'):
+        workdir = fetch_source(tmp_dir, git_repo, git_revision, source_tarball)
+    if workdir is None:
+        return "fatal: could not fetch nixpkgs {}".format(git_revision)
+    if output is None:
+        with get_metrics().stage('mirror_tarballs.evaluate'):
+            expr, output = find_tarballs(workdir, target_dir, git_revision)
+        if output is None:
+            return "fatal: all nix instantiate processes failed!"
+    else:
+        print("using cached evaluation of {}".format(git_revision))
+    previous = find_previous_revision(target_dir, git_revision, expr)
+    if previous is not None:
+        total = len(output)
+        output = new_entries(target_dir, output, previous, expr)
+        print("{} of {} entries are new since {}".format(len(output), total, previous))
     for idx, entry in enumerate(output):
         if not (len( [ x for x in VALID_URL_SCHEMES if entry['url'].startswith(x) ]) == 1):
-            append_failed_entry(entry)
+            append_failed_entry(failed_entries, entry)
             print("url {} is not in the supported url schemes.".format(entry['url']))
             continue
-        elif (len(check_presence(target_dir, entry['hash'])) or
-              len(check_presence(target_dir, entry['name']))):
+        elif entry['hash'] in index:
             print("url {} already mirrored".format(entry['url']))
             continue
         else:
             download_queue.put(entry)
+    start = time.monotonic()
     for i in range(concurrent):
-        t = threading.Thread(target=download_worker, args=(target_dir, git_revision, repo.workdir, ))
+        t = threading.Thread(target=download_worker, args=(download_queue, failed_entries, target_dir, git_revision, workdir, index, ))
         threads.append(t)
         t.start()
     download_queue.join()
@@ -206,6 +446,8 @@ def mirror_tarballs(target_dir, tmp_dir, git_repo, git_revision, concurrent=DEFA
         download_queue.put(None)
     for t in threads:
         t.join()
+    flush_store_delete()
+    get_metrics().record('mirror_tarballs.download', time.monotonic() - start)
     log = "########################\n"
     log += "SUMMARY OF FAILED FILES:\n"
     log += "########################\n"
@@ -213,4 +455,6 @@ def mirror_tarballs(target_dir, tmp_dir, git_repo, git_revision, concurrent=DEFA
         log += "url:{}, name:{}\n".format(entry['url'], entry['name'])
     with open(os.path.join(target_dir, "revisions", git_revision, "log"), "w") as f:
         f.write(log)
+    with open(os.path.join(target_dir, "revisions", git_revision, "failed.json"), "w") as f:
+        json.dump(failed_entries, f)
     return log
@@ -0,0 +1,135 @@
+import os
+import sqlite3
+import threading
+
+from nixipfs.nix_helpers import hash_part_in_path, NarInfo
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS narinfos (
+           hash TEXT PRIMARY KEY,
+           url TEXT,
+           file_hash TEXT,
+           nar_size INTEGER,
+           text TEXT NOT NULL)''',
+    '''CREATE TABLE IF NOT EXISTS refs (
+           hash TEXT NOT NULL,
+           ref TEXT NOT NULL,
+           PRIMARY KEY (hash, ref)) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS links (
+           release TEXT NOT NULL,
+           name TEXT NOT NULL,
+           PRIMARY KEY (release, name)) WITHOUT ROWID'''
+]
+
+CLOSURE_QUERY = '''
+    WITH RECURSIVE closure(hash) AS (
+        SELECT hash FROM roots
+        UNION
+        SELECT refs.ref FROM refs JOIN closure ON refs.hash = closure.hash
+    )
+    SELECT closure.hash, narinfos.{} FROM closure
+    LEFT JOIN narinfos ON narinfos.hash = closure.hash'''
+
+def narinfo_name(h):
+    return h + ".narinfo"
+
+def narinfo_hash(name):
+    return name[:-len(".narinfo")] if name.endswith(".narinfo") else name
+
+def release_key(release):
+    return os.path.realpath(release)
+
+class NarInfoIndex:
+    """Persistent store of all narinfos seen so far, keyed by store hash.
+
+    The References of every narinfo are kept as an edge list so the known
+    part of a closure can be computed with a single query. The files every
+    release links to (names relative to the binary cache) are recorded as
+    well, the garbage collector marks them without listing the releases."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        for stmt in SCHEMA:
+            self.db.execute(stmt)
+        self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def get(self, name):
+        with self.lock:
+            row = self.db.execute('SELECT text FROM narinfos WHERE hash = ?', (narinfo_hash(name),)).fetchone()
+        return row[0] if row is not None else None
+
+    def add_many(self, narinfos):
+        """narinfos is an iterable of (name, NarInfo)"""
+        rows = []
+        edges = []
+        for name, ni in narinfos:
+            h = narinfo_hash(name)
+            rows.append((h, ni.d.get('URL'), ni.d.get('FileHash'), ni.d.get('NarSize'), ni.to_string()))
+            for ref in ni.d.get('References', '').split(' '):
+                if len(ref):
+                    edges.append((h, hash_part_in_path(ref)))
+        with self.lock:
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO narinfos VALUES (?, ?, ?, ?, ?)', rows)
+                self.db.executemany('INSERT OR IGNORE INTO refs VALUES (?, ?)', edges)
+
+    def _closure(self, names, column):
+        with self.lock:
+            with self.db:
+                self.db.execute('CREATE TEMP TABLE IF NOT EXISTS roots (hash TEXT PRIMARY KEY)')
+                self.db.execute('DELETE FROM roots')
+                self.db.executemany('INSERT OR IGNORE INTO roots VALUES (?)',
+                                    [ (narinfo_hash(n),) for n in names ])
+                return self.db.execute(CLOSURE_QUERY.format(column)).fetchall()
+
+    def closure(self, names):
+        """Returns ({name: text} of all indexed narinfos reachable from names,
+        [names] of reachable narinfos that are not indexed yet)"""
+        known = {}
+        missing = []
+        for h, text in self._closure(names, 'text'):
+            if text is None:
+                missing.append(narinfo_name(h))
+            else:
+                known[narinfo_name(h)] = text
+        return known, missing
+
+    def closure_urls(self, names):
+        """Like closure() but returns {name: nar url} for the indexed narinfos"""
+        known = {}
+        missing = []
+        for h, url in self._closure(names, 'url'):
+            if url is None:
+                missing.append(narinfo_name(h))
+            else:
+                known[narinfo_name(h)] = url
+        return known, missing
+
+    def add_links(self, release, names):
+        with self.lock:
+            with self.db:
+                self.db.executemany('INSERT OR IGNORE INTO links VALUES (?, ?)',
+                                    [ (release_key(release), n) for n in names ])
+
+    def links(self, release):
+        """Returns the set of names linked by release, None if they were never recorded"""
+        with self.lock:
+            rows = self.db.execute('SELECT name FROM links WHERE release = ?', (release_key(release),)).fetchall()
+        return set([ row[0] for row in rows ]) if len(rows) else None
+
+    def releases(self):
+        with self.lock:
+            return [ row[0] for row in self.db.execute('SELECT DISTINCT release FROM links') ]
+
+    def forget(self, releases):
+        with self.lock:
+            with self.db:
+                self.db.executemany('DELETE FROM links WHERE release = ?',
+                                    [ (release_key(r),) for r in releases ])
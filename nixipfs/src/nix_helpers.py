@@ -1,5 +1,16 @@
-import subprocess
 import os
+import hashlib
+import base64
+import struct
+
+from nixipfs.concurrency import hashing_slots
+from nixipfs.defaults import *
+
+HASH_TYPES = [ "md5", "sha1", "sha256", "sha512" ]
+HASH_BASES = [ "base16", "base32", "base64" ]
+
+# Nix uses its own base32 alphabet (no e, o, u, t)
+NIX_BASE32_CHARS = "0123456789abcdfghijklmnpqrsvwxyz"
 
 def hash_part_in_path(path):
     if path.count('/') >= 3:
@@ -18,13 +29,164 @@ def nar_info_from_path(path):
     else:
         return ""
 
-# TODO implement in pure python
-def nix_hash(path, hash_type="sha256", base="base32"):
+def nix_base32(digest):
+    # Port of printHash32 from libutil/hash.cc
+    length = (len(digest) * 8 - 1) // 5 + 1
+    res = []
+    for n in range(length - 1, -1, -1):
+        b = n * 5
+        i = b // 8
+        j = b % 8
+        c = digest[i] >> j
+        if i < len(digest) - 1:
+            c |= digest[i + 1] << (8 - j)
+        res.append(NIX_BASE32_CHARS[c & 0x1f])
+    return "".join(res)
+
+def encode_hash(digest, base="base32"):
+    assert(base in HASH_BASES)
+    if base == "base16":
+        return digest.hex()
+    elif base == "base32":
+        return nix_base32(digest)
+    else:
+        return base64.b64encode(digest).decode('ascii')
+
+class MultiHash:
+    """Feeds the same data into several hash algorithms at once."""
+    def __init__(self, hash_types=HASH_TYPES):
+        for hash_type in hash_types:
+            assert(hash_type in HASH_TYPES)
+        self.hashes = { t : hashlib.new(t) for t in hash_types }
+
+    def update(self, data):
+        for h in self.hashes.values():
+            h.update(data)
+
+    def digest(self, hash_type):
+        return self.hashes[hash_type].digest()
+
+    def hexdigest(self, hash_type, base="base16"):
+        return encode_hash(self.digest(hash_type), base)
+
+    def matches(self, hash_type, value):
+        # accepts base16/base32/base64, "type:hash" and SRI ("type-base64")
+        if value.startswith(hash_type + '-'):
+            return self.hexdigest(hash_type, "base64") == value[len(hash_type) + 1:]
+        if ':' in value:
+            value = value.split(':', 1)[1]
+        return value in [ self.hexdigest(hash_type, base) for base in HASH_BASES ]
+
+    def update_from_file(self, f, chunk_size=DEFAULT_HASH_CHUNK_SIZE):
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            self.update(view[:n])
+
+def nix_hashes(path, hash_types=HASH_TYPES):
+    # Reads the file only once, regardless of the number of hash types
     assert(os.path.isfile(path))
-    assert(hash_type in [ "md5", "sha1", "sha256", "sha512" ])
-    assert(base      in [ "base16", "base32", "base64" ])
-    h_res = subprocess.run("nix hash-file --{} --type {} {}".format(base, hash_type, path), shell=True, stdout=subprocess.PIPE)
-    return h_res.stdout.decode('utf-8').strip()
+    mh = MultiHash(hash_types)
+    with hashing_slots, open(path, 'rb') as f:
+        mh.update_from_file(f)
+    return mh
+
+def nix_hash(path, hash_type="sha256", base="base32"):
+    assert(hash_type in HASH_TYPES)
+    assert(base      in HASH_BASES)
+    return nix_hashes(path, [ hash_type ]).hexdigest(hash_type, base)
+
+class NarError(Exception):
+    pass
+
+class NarReader:
+    """Sequential reader for the NAR format (see nix/src/libutil/archive.cc).
+    Works on any stream with read(), nothing is buffered besides the current chunk."""
+    def __init__(self, f):
+        self.f = f
+
+    def _read_exact(self, n):
+        buf = b''
+        while len(buf) < n:
+            chunk = self.f.read(n - len(buf))
+            if not chunk:
+                raise NarError("unexpected end of NAR")
+            buf += chunk
+        return buf
+
+    def _read_int(self):
+        return struct.unpack('<Q', self._read_exact(8))[0]
+
+    def _read_str(self):
+        n = self._read_int()
+        s = self._read_exact(n)
+        self._read_exact(-n % 8)
+        return s
+
+    def _expect(self, s):
+        t = self._read_str()
+        if t != s:
+            raise NarError("expected {} in NAR, got {}".format(s, t[:64]))
+
+    def _contents(self, n, out):
+        remaining = n
+        while remaining:
+            chunk = self.f.read(min(remaining, DEFAULT_HASH_CHUNK_SIZE))
+            if not chunk:
+                raise NarError("unexpected end of NAR")
+            remaining -= len(chunk)
+            if out is not None:
+                out.write(chunk)
+        self._read_exact(-n % 8)
+
+    def extract(self, path_in_nar, out):
+        """Streams the regular file at path_in_nar ('' or '/' for the root) to out.
+        Stops reading right after it, returns False if the file is not in the NAR."""
+        target = [ c.encode('utf-8') for c in path_in_nar.split('/') if len(c) ]
+        self._expect(b'nix-archive-1')
+        return self._node(target, out)
+
+    def _node(self, target, out):
+        # target is the remaining path below this node, None if this node is not on the way
+        self._expect(b'(')
+        self._expect(b'type')
+        node_type = self._read_str()
+        if node_type == b'regular':
+            tag = self._read_str()
+            if tag == b'executable':
+                self._expect(b'')
+                tag = self._read_str()
+            if tag != b'contents':
+                raise NarError("expected contents in NAR, got {}".format(tag[:64]))
+            found = target == []
+            self._contents(self._read_int(), out if found else None)
+            if found:
+                return True
+        elif node_type == b'symlink':
+            self._expect(b'target')
+            self._read_str()
+        elif node_type == b'directory':
+            while True:
+                tag = self._read_str()
+                if tag == b')':
+                    return False
+                if tag != b'entry':
+                    raise NarError("expected entry in NAR, got {}".format(tag[:64]))
+                self._expect(b'(')
+                self._expect(b'name')
+                name = self._read_str()
+                self._expect(b'node')
+                on_path = target is not None and len(target) and target[0] == name
+                if self._node(target[1:] if on_path else None, out):
+                    return True
+                self._expect(b')')
+        else:
+            raise NarError("unknown node type {} in NAR".format(node_type[:64]))
+        self._expect(b')')
+        return False
 
 class NarInfo:
     def __init__(self, text = ""):
@@ -0,0 +1,66 @@
+import queue
+import threading
+import traceback
+
+class Stage:
+    def __init__(self, name, func, workers=1):
+        """func(item, value) is called with the value returned by the previous
+        stage (None for the first one) and returns the value for the next stage"""
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = queue.Queue()
+
+class Pipeline:
+    """Runs every item through a sequence of stages.
+
+    Each stage has its own queue and worker threads, so while one item is in
+    a later stage the next one can already occupy an earlier stage. The number
+    of workers of a stage limits how many items use its resources at once.
+    An item that fails in a stage skips all following stages."""
+    def __init__(self, stages):
+        self.stages = stages
+        self.lock = threading.Lock()
+        self.results = {}
+        self.failures = []
+
+    def _worker(self, idx):
+        stage = self.stages[idx]
+        while True:
+            work = stage.queue.get()
+            if work is None:
+                break
+            key, item, value = work
+            try:
+                value = stage.func(item, value)
+            except Exception as e:
+                traceback.print_exc()
+                with self.lock:
+                    self.failures.append((item, stage.name, e))
+            else:
+                if idx + 1 < len(self.stages):
+                    self.stages[idx + 1].queue.put((key, item, value))
+                else:
+                    with self.lock:
+                        self.results[key] = value
+            stage.queue.task_done()
+
+    def run(self, items):
+        """Returns ([final value of each successful item in input order],
+        [(item, stage name, exception)] of the failed items)"""
+        threads = []
+        for idx, stage in enumerate(self.stages):
+            for i in range(stage.workers):
+                t = threading.Thread(target=self._worker, args=(idx, ))
+                threads.append(t)
+                t.start()
+        for key, item in enumerate(items):
+            self.stages[0].queue.put((key, item, None))
+        # Items only move forward, a stage is done once all stages before it are
+        for stage in self.stages:
+            stage.queue.join()
+            for i in range(stage.workers):
+                stage.queue.put(None)
+        for t in threads:
+            t.join()
+        return [ self.results[k] for k in sorted(self.results.keys()) ], self.failures
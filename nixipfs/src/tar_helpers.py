@@ -0,0 +1,60 @@
+import contextlib
+import lzma
+import os
+import shutil
+import subprocess
+import tarfile
+
+from nixipfs.defaults import *
+
+def extract_until(archive, dest, stop):
+    """Extracts the members of archive to dest in a single sequential pass and
+    stops at the first member name for which stop(name) is true.
+
+    Returns that name, or None if the whole archive has been extracted.
+    dest may be None to only look for the member. Extracted files and
+    directories stay writable, they are only a working copy."""
+    with tarfile.open(archive, 'r|*') as tar:
+        for member in tar:
+            if stop(member.name):
+                return member.name
+            if dest is not None:
+                member.mode |= 0o700 if member.isdir() else 0o600
+                tar.extract(member, dest)
+    return None
+
+@contextlib.contextmanager
+def xz_writer(path, threads=DEFAULT_XZ_THREADS, preset=DEFAULT_XZ_PRESET):
+    """Writes an xz file with the multithreaded (block mode) xz if it is
+    available, python's lzma only uses a single core"""
+    with open(path, 'wb') as out:
+        if shutil.which('xz') is None:
+            with lzma.open(out, 'w', preset=preset) as f:
+                yield f
+            return
+        p = subprocess.Popen([ 'xz', '-c', '-{}'.format(preset), '--threads={}'.format(threads) ],
+                             stdin=subprocess.PIPE, stdout=out)
+        try:
+            yield p.stdin
+        finally:
+            p.stdin.close()
+            if p.wait() != 0:
+                raise subprocess.CalledProcessError(p.returncode, 'xz')
+
+def rewrite_tar_xz(src, dest, extra):
+    """Copies all members of the tarball src into the tar.xz dest and appends
+    the files [(path, arcname)] of extra. Nothing is extracted, src is read
+    and dest is written as a stream."""
+    part = dest + '.part'
+    try:
+        with xz_writer(part) as out:
+            with tarfile.open(src, 'r|*') as old, tarfile.open(fileobj=out, mode='w|') as new:
+                for member in old:
+                    new.addfile(member, old.extractfile(member) if member.isreg() else None)
+                for path, arcname in extra:
+                    new.add(path, arcname=arcname)
+        os.replace(part, dest)
+    except:
+        if os.path.exists(part):
+            os.unlink(part)
+        raise
@@ -4,47 +4,162 @@ import sys
 import subprocess
 import time
 import queue
+import shutil
+import tempfile
 import threading
+import traceback
 import urllib
+import urllib.parse
+from glob import glob
 
 from nixipfs.nix_helpers import *
 from nixipfs.download_helpers import *
+from nixipfs.http_client import get_client
+from nixipfs.async_narinfo import collect_narinfos_async
+from nixipfs.narinfo_index import NarInfoIndex
+from nixipfs.garbage_collect import release_links
+from nixipfs.metrics import get_metrics
+from nixipfs.concurrency import AdaptiveLimiter, DiskBudget
+from nixipfs.utils import periodic
 from nixipfs.defaults import *
 
-def download_worker(binary_cache):
-    global nar_queue
+def download_worker(binary_cache, nar_queue, limiter, disk_budget):
     while True:
         work = nar_queue.get()
         if work is None:
             break
-        # try a few times to correct a corrupt download
-        for x in range(0, DEFAULT_DOWNLOAD_TRIES):
-            try:
-                download_file_from_cache(work[0], work[1], binary_cache)
-            except DownloadFailed:
-                break
+        # the hash is verified while downloading, corrupt downloads are retried
+        try:
+            # another release that is synced at the same time may have downloaded it
             if os.path.isfile(work[1]):
-                if nix_hash(work[1], work[2].split(':')[0], "base32") == work[2].split(':')[1].strip():
-                    break
-                else:
-                    print("Hash verification for {} failed. Retrying.".format(work[1]))
-                    os.unlink(work[1])
-        if not os.path.isfile(work[1]):
+                continue
+            with disk_budget.reserve(work[3]):
+                download_file_from_cache(work[0], work[1], binary_cache, file_hash=work[2], limiter=limiter)
+            get_metrics().count('update_binary_cache.nar', 'files')
+            get_metrics().count('update_binary_cache.nar', 'bytes', os.path.getsize(work[1]))
+        except DownloadFailed:
             print("Could not download {}".format(work[0]))
-        nar_queue.task_done()
+            get_metrics().count('update_binary_cache.nar', 'failed')
+        except Exception:
+            traceback.print_exc()
+            get_metrics().count('update_binary_cache.nar', 'failed')
+        finally:
+            nar_queue.task_done()
 
-def narinfo_worker(cache, local_cache):
-    global nic
+def narinfo_worker(nic, cache, local_cache, index, limiter):
     while True:
         work = nic.get_work()
         if work is None:
             break
-        narinfo = fetch_file_from_cache(work, cache, local_cache)
-        nic.turn_in(work, narinfo)
+        try:
+            narinfo = fetch_file_from_cache(work, cache, local_cache, index=index, limiter=limiter)
+            if len(narinfo):
+                nic.turn_in(work, narinfo)
+                continue
+            print("Could not fetch {}".format(work))
+        except DownloadFailed as e:
+            print(e)
+        except Exception:
+            traceback.print_exc()
+        nic.give_up(work)
 
-def update_binary_cache(cache, release, outdir, concurrent=DEFAULT_CONCURRENT_DOWNLOADS, print_only=False, cache_info=None):
-    global nar_queue
-    global nic
+class NarInfoSink:
+    """Receives every narinfo of the closure from the NarInfoCollector as soon
+    as it is known: writes it to the binary cache, adds fetched ones to the
+    index and queues the NAR for download (unless nar_queue is None).
+    Only the names and NAR urls are kept for linking the release."""
+    def __init__(self, binary_cache_path, index, nar_queue):
+        self.binary_cache_path = binary_cache_path
+        self.index = index
+        self.nar_queue = nar_queue
+        self.lock = threading.Lock()
+        self.names = set()
+        self.nars = {}
+        self.fetched = 0
+        self.unindexed = []
+
+    def __call__(self, name, ni, fetched):
+        # nothing that can't be served is written to the shared binary cache
+        if not ('URL' in ni.d and 'FileHash' in ni.d):
+            raise DownloadFailed("{} is not a valid narinfo".format(name))
+        # indexed narinfos are already on disk unless the file has been deleted
+        narinfo_path = os.path.join(self.binary_cache_path, name)
+        if fetched or not os.path.isfile(narinfo_path):
+            # replaced atomically, concurrent releases read narinfos they share from here
+            fd, tmp = tempfile.mkstemp(dir=self.binary_cache_path, prefix='.incoming')
+            with os.fdopen(fd, 'w') as f:
+                f.write(ni.to_string())
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, narinfo_path)
+        url = ni.d['URL']
+        batch = None
+        with self.lock:
+            self.names.add(name)
+            new_nar = url not in self.nars
+            self.nars[url] = ni.d['FileHash']
+            if fetched:
+                self.fetched += 1
+                self.unindexed.append((name, ni))
+                if len(self.unindexed) >= DEFAULT_INDEX_BATCH:
+                    batch, self.unindexed = self.unindexed, []
+        if batch is not None:
+            self.index.add_many(batch)
+        nar_location_disk = os.path.join(self.binary_cache_path, url)
+        if new_nar and self.nar_queue is not None and not os.path.isfile(nar_location_disk):
+            self.nar_queue.put([url, nar_location_disk, ni.d['FileHash'], int(ni.d.get('FileSize', 0))])
+
+    def flush(self):
+        with self.lock:
+            batch, self.unindexed = self.unindexed, []
+        self.index.add_many(batch)
+
+def has_entries(path):
+    with os.scandir(path) as it:
+        return next(it, None) is not None
+
+def find_previous_release(release):
+    release = os.path.abspath(release)
+    candidates = [ e.rstrip('/') for e in glob(os.path.dirname(release) + '/*/') ]
+    candidates = [ c for c in candidates if os.path.abspath(c) != release and
+                   os.path.isfile(os.path.join(c, 'store-paths')) and
+                   os.path.isfile(os.path.join(c, 'git-revision')) and
+                   os.path.isdir(os.path.join(c, 'binary_cache', 'nar')) ]
+    if not len(candidates):
+        return None
+    # git-revision is written once when a release is created and never touched
+    # again, unlike the ctime of the directory which every new link changes
+    candidates.sort(key=lambda x: os.path.getmtime(os.path.join(x, 'git-revision')))
+    return candidates[-1]
+
+def clone_release_links(prev_release, linked_cache_path, binary_cache_path, narinfos):
+    # Recreates the links of the previous release for all given narinfos,
+    # returns { name : nar link } of the narinfos that could be reused
+    prev_cache_path = os.path.join(prev_release, 'binary_cache')
+    prev_narinfos = set(os.listdir(prev_cache_path))
+    prev_nars = set(os.listdir(os.path.join(prev_cache_path, 'nar')))
+    narinfo_prefix = os.path.relpath(binary_cache_path, linked_cache_path)
+    nar_prefix = os.path.relpath(os.path.join(binary_cache_path, 'nar'), os.path.join(linked_cache_path, 'nar'))
+    present = set(os.listdir(linked_cache_path))
+    present_nars = set(os.listdir(os.path.join(linked_cache_path, 'nar')))
+
+    reused = {}
+    for name, text in narinfos.items():
+        nar = os.path.basename(NarInfo(text).d['URL'])
+        if not (name in prev_narinfos and nar in prev_nars):
+            continue
+        if name not in present:
+            os.symlink(os.path.join(narinfo_prefix, name), os.path.join(linked_cache_path, name))
+        if nar not in present_nars:
+            os.symlink(os.path.join(nar_prefix, nar), os.path.join(linked_cache_path, 'nar', nar))
+            present_nars.add(nar)
+        reused[name] = os.path.join('nar', nar)
+    return reused
+
+def update_binary_cache(cache, release, outdir, concurrent=DEFAULT_CONCURRENT_DOWNLOADS, print_only=False, cache_info=None,
+                        async_narinfo=False, max_requests=DEFAULT_ASYNC_NARINFO_REQUESTS, delta=False,
+                        limiter=None, disk_budget=None):
+    """limiter and disk_budget can be shared by releases that are synced at
+    the same time from the same binary cache to the same outdir"""
     binary_cache_path = os.path.join(outdir, 'binary_cache')
     linked_cache_path = os.path.join(release, 'binary_cache')
     assert(os.path.isdir(release))
@@ -55,60 +170,117 @@ def update_binary_cache(cache, release, outdir, concurrent=DEFAULT_CONCURRENT_DO
         store_paths = f.read()
 
     threads = []
-    nic = NarInfoCollector()
-    nic.start(store_paths.split('\n'))
-    for i in range(concurrent):
-        t = threading.Thread(target=narinfo_worker, args=(cache, binary_cache_path))
-        threads.append(t)
-        t.start()
-    nic.queue.join()
-    for i in range(concurrent):
-        nic.queue.put(None)
-    for t in threads:
-        t.join()
-    threads = []
+    # Resolve as much of the closure as possible from the local index,
+    # only the unknown part is walked over the network
+    index = NarInfoIndex(os.path.join(outdir, 'narinfo-index.sqlite'))
+    roots = [ nar_info_from_path(p) for p in store_paths.split('\n') if len(p) ]
+    # Links made before the index recorded them are listed once
+    unrecorded = index.links(release) is None and has_entries(os.path.join(linked_cache_path, 'nar'))
 
-    # Write NarInfo files
-    for ni in nic.collection:
-        with open(os.path.join(binary_cache_path, ni[0]), 'w') as f:
-            f.write(ni[1].to_string())
-    # Figure out all nars and the fileHash that we want to fetch
-    nars = { ni[1].d['URL'] : ni[1].d['FileHash'] for ni in nic.collection }
+    # In delta mode the closure of all roots that were already part of the previous
+    # release is linked like in the previous release and not processed any further
+    reused = {}
+    prev_release = find_previous_release(release) if delta and not print_only else None
+    if prev_release is not None:
+        with open(os.path.join(prev_release, 'store-paths'), 'r') as f:
+            prev_roots = set([ nar_info_from_path(p) for p in f.read().split('\n') if len(p) ])
+        kept_closure, _ = index.closure([ r for r in roots if r in prev_roots ])
+        reused = clone_release_links(prev_release, linked_cache_path, binary_cache_path, kept_closure)
+        print("delta: {} of {} roots are new since {}".format(
+            len([ r for r in roots if r not in prev_roots ]), len(roots), os.path.basename(prev_release)))
 
-    if print_only:
-        for nar, filehash in nars.items():
-            print("{},{}".format(nar, filehash))
-    else:
-        nar_queue = queue.Queue()
+    start = time.monotonic()
+    known, missing = index.closure(roots)
+    sink = NarInfoSink(binary_cache_path, index, None if print_only else queue.Queue())
+    nar_queue = sink.nar_queue
+    nic = NarInfoCollector(sink)
+    nic.skip(reused)
+    # concurrent (max_requests) is the upper bound, the limiter finds out how
+    # many requests the binary cache serves without slowing down or failing.
+    # narinfo and NAR requests go to the same cache and share its limit.
+    # the async client connects directly, behind a proxy narinfos are fetched by threads
+    if async_narinfo and get_client().proxy(urllib.parse.urlsplit(cache)) is not None:
+        print("{} is reached through a proxy, not using async_narinfo".format(cache))
+        async_narinfo = False
+    if limiter is None:
+        limiter = AdaptiveLimiter('update_binary_cache.requests', maximum=max_requests if async_narinfo else concurrent)
+    if disk_budget is None:
+        disk_budget = DiskBudget(min(DEFAULT_NAR_DISK_BUDGET, shutil.disk_usage(binary_cache_path).free))
+    # NARs are downloaded while the rest of the closure is still being discovered
+    if not print_only:
         for i in range(concurrent):
-            t = threading.Thread(target=download_worker, args=(cache, ))
+            t = threading.Thread(target=download_worker, args=(cache, nar_queue, limiter, disk_budget))
             threads.append(t)
             t.start()
-        for url, file_hash in nars.items():
-            nar_location_disk = os.path.join(binary_cache_path, url)
-            if not os.path.isfile(nar_location_disk):
-                nar_queue.put([url, nar_location_disk, file_hash])
-        nar_queue.join()
+    nic.preload({ k : v for k, v in known.items() if k not in reused })
+    for name in missing:
+        nic.add_work(name)
+    nic.start(store_paths.split('\n'))
+    print("narinfo index: {} known, {} to fetch".format(len(known) - len(reused), nic.queue.qsize()))
+    if async_narinfo:
+        collect_narinfos_async(nic, cache, binary_cache_path, max_requests, index, limiter)
+    else:
+        narinfo_threads = []
+        for i in range(concurrent):
+            t = threading.Thread(target=narinfo_worker, args=(nic, cache, binary_cache_path, index, limiter))
+            narinfo_threads.append(t)
+            t.start()
+        with periodic(lambda: print("narinfo: {} collected, {} queued, {}".format(
+                nic.collected, nic.queue.qsize(), limiter.summary()))):
+            nic.queue.join()
+        for i in range(concurrent):
+            nic.queue.put(None)
+        for t in narinfo_threads:
+            t.join()
+
+    sink.flush()
+    get_metrics().record('update_binary_cache.narinfo', time.monotonic() - start)
+    get_metrics().add('update_binary_cache.narinfo', { 'indexed' : len(known) - len(reused),
+                                                       'fetched' : sink.fetched,
+                                                       'reused' : len(reused) })
+    if prev_release is not None:
+        print("delta: reused {} paths from {}, processed {} paths".format(
+            len(reused), os.path.basename(prev_release), len(sink.names)))
+
+    if not print_only:
+        with periodic(lambda: print("nar: {} queued, {}".format(nar_queue.qsize(), limiter.summary()))):
+            nar_queue.join()
         for i in range(concurrent):
             nar_queue.put(None)
         for t in threads:
             t.join()
+        get_metrics().record('update_binary_cache.nar', time.monotonic() - start)
+    limiter.report()
+    print("binary cache: {}, {}".format(get_client().summary(), limiter.summary()))
+
+    if print_only:
+        for nar, filehash in sink.nars.items():
+            print("{},{}".format(nar, filehash))
+    else:
         # All nars/narinfos have been written, link to them
-        with ccd(linked_cache_path):
-            for ni in nic.collection:
-                # Produces xyz.narinfo -> ../../binary_cache/xyz.narinfo
-                target = os.path.join(binary_cache_path, ni[0])
-                assert(os.path.isfile(target))
-                if not os.path.isfile(os.path.basename(ni[0])):
-                    os.symlink(os.path.relpath(target), ni[0])
-        with ccd(os.path.join(linked_cache_path, 'nar')):
-            for nar, file_hash in nars.items():
-                target = os.path.join(binary_cache_path, 'nar', os.path.basename(nar))
-                assert(os.path.isfile(target))
-                if not os.path.isfile(os.path.basename(nar)):
-                    os.symlink(os.path.relpath(target), os.path.basename(nar))
+        # (without changing the working directory, other releases may be processed concurrently)
+        for name in sink.names:
+            # Produces xyz.narinfo -> ../../binary_cache/xyz.narinfo
+            target = os.path.join(binary_cache_path, name)
+            assert(os.path.isfile(target))
+            link = os.path.join(linked_cache_path, os.path.basename(name))
+            if not os.path.isfile(link):
+                os.symlink(os.path.relpath(target, linked_cache_path), link)
+        linked_nar_path = os.path.join(linked_cache_path, 'nar')
+        for nar in sink.nars.keys():
+            target = os.path.join(binary_cache_path, 'nar', os.path.basename(nar))
+            assert(os.path.isfile(target))
+            link = os.path.join(linked_nar_path, os.path.basename(nar))
+            if not os.path.isfile(link):
+                os.symlink(os.path.relpath(target, linked_nar_path), link)
+        # garbage_collect marks the links of a release from the index
+        if unrecorded:
+            index.add_links(release, release_links(release))
+        index.add_links(release, list(sink.names) + list(reused.keys()) + list(reused.values()) +
+                                 [ os.path.join('nar', os.path.basename(nar)) for nar in sink.nars.keys() ])
         if cache_info is not None:
             nci = NarInfo()
             nci.d = cache_info
             with open(os.path.join(linked_cache_path, 'nix-cache-info'), 'w') as f:
                 f.write(nci.to_string())
+    index.close()
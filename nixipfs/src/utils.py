@@ -1,7 +1,10 @@
 import contextlib
 import os
+import threading
 from progress.bar import Bar
 
+from nixipfs.defaults import *
+
 class LJustBar(Bar):
     def __init__(self, message=None, width=16, **kwargs):
         super(Bar, self).__init__(message.ljust(max(width, len(message))), **kwargs)
@@ -12,3 +15,18 @@ def ccd(path):
     os.chdir(path)
     yield
     os.chdir(cur)
+
+@contextlib.contextmanager
+def periodic(func, interval=DEFAULT_PROGRESS_INTERVAL):
+    # calls func every interval seconds while the block runs, e.g. to print progress
+    stop = threading.Event()
+    def run():
+        while not stop.wait(interval):
+            func()
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        t.join()
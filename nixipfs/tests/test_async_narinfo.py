@@ -0,0 +1,37 @@
+import socket
+import unittest
+from unittest import mock
+
+from nixipfs.async_narinfo import AsyncHTTPClient, collect_narinfos_async
+from nixipfs.concurrency import AdaptiveLimiter
+from nixipfs.download_helpers import NarInfoCollector
+
+def closed_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+class CollectTest(unittest.TestCase):
+    @mock.patch('nixipfs.async_narinfo.backoff_delay', lambda *args: 0)
+    def test_refused_connection_gives_up(self):
+        # every path is given up on, the walk itself must not fail
+        nic = NarInfoCollector()
+        nic.start([ '/nix/store/{}-foo'.format('a' * 32), '/nix/store/{}-bar'.format('b' * 32) ])
+        limiter = AdaptiveLimiter('test', initial=4, maximum=4)
+        with mock.patch.object(AsyncHTTPClient, 'close', autospec=True,
+                               side_effect=AsyncHTTPClient.close) as close:
+            collect_narinfos_async(nic, 'http://127.0.0.1:{}'.format(closed_port()), limiter=limiter)
+        client = close.call_args[0][0]
+        self.assertEqual(nic.collection, [])
+        self.assertEqual(len(nic.work), 0)
+        self.assertEqual(len(nic.work_done), 2)
+        self.assertEqual(client.counters['requests'], 0)
+        self.assertGreater(client.counters['errors'], 0)
+        # a refused connection is a sign of congestion
+        self.assertGreater(limiter.errors, 0)
+        self.assertLess(limiter.limit, 4)
+
+if __name__ == '__main__':
+    unittest.main()
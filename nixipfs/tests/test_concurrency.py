@@ -0,0 +1,33 @@
+import unittest
+import urllib.error
+
+from nixipfs.concurrency import AdaptiveLimiter
+from nixipfs.download_helpers import HashMismatch
+
+def fail(limiter, e):
+    try:
+        with limiter.slot():
+            raise e
+    except type(e):
+        pass
+
+class AdaptiveLimiterTest(unittest.TestCase):
+    def test_neutral_failures(self):
+        limiter = AdaptiveLimiter('test', initial=2, maximum=16)
+        for i in range(10):
+            fail(limiter, urllib.error.HTTPError('http://cache/x.narinfo', 404, 'not found', {}, None))
+            fail(limiter, HashMismatch('Hash verification for x failed'))
+        self.assertEqual(limiter.limit, 2)
+        self.assertEqual(limiter.errors, 0)
+
+    def test_success_and_congestion(self):
+        limiter = AdaptiveLimiter('test', initial=2, maximum=16)
+        with limiter.slot():
+            pass
+        self.assertEqual(limiter.limit, 3)
+        fail(limiter, urllib.error.HTTPError('http://cache/x.narinfo', 503, 'unavailable', {}, None))
+        self.assertEqual(limiter.limit, 1)
+        self.assertEqual(limiter.errors, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from nixipfs.benchmark import SyntheticCache, FakeBinaryCache
+from nixipfs.garbage_collect import mark, find_garbage, garbage_collect
+from nixipfs.narinfo_index import NarInfoIndex
+from nixipfs.update_binary_cache import update_binary_cache
+
+def baseline_live(releases):
+    # what find_garbage used to keep: everything linked from a release directory
+    links = set()
+    for release in releases:
+        linked_cache_path = os.path.join(release, 'binary_cache')
+        links.update([ e for e in os.listdir(linked_cache_path) if '.narinfo' in e ])
+        links.update([ os.path.join('nar', e) for e in os.listdir(os.path.join(linked_cache_path, 'nar')) if '.nar' in e ])
+    return links
+
+class MarkTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.cache = SyntheticCache(paths=60, depth=3, refs=2, nar_size=(64, 256), churn=0.5)
+        cls.server = FakeBinaryCache(cls.cache)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='nixipfs-test')
+        self.outdir = os.path.join(self.workdir, 'out')
+        self.binary_cache = os.path.join(self.outdir, 'binary_cache')
+        self.releases = []
+        for roots in self.cache.roots:
+            release = os.path.join(self.outdir, 'releases', 'r{}'.format(len(self.releases)))
+            os.makedirs(release)
+            with open(os.path.join(release, 'store-paths'), 'w') as f:
+                f.write('\n'.join(roots))
+            with open(os.path.join(release, 'git-revision'), 'w') as f:
+                f.write('0' * 40)
+            update_binary_cache(self.server.url, release, self.outdir, concurrent=4, delta=True)
+            self.releases.append(release)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_mark_matches_links(self):
+        with mock.patch('os.listdir', side_effect=AssertionError('release listed')):
+            live = mark(self.binary_cache, self.releases)
+        self.assertEqual(live, baseline_live(self.releases))
+        self.assertEqual(mark(self.binary_cache, self.releases[1:]), baseline_live(self.releases[1:]))
+
+    def test_unrecorded_release_is_listed(self):
+        index = NarInfoIndex(os.path.join(self.outdir, 'narinfo-index.sqlite'))
+        index.forget(self.releases[:1])
+        index.close()
+        self.assertEqual(mark(self.binary_cache, self.releases), baseline_live(self.releases))
+
+    def test_garbage_collect_keeps_linked_files(self):
+        live = baseline_live(self.releases[1:])
+        garbage = find_garbage(self.binary_cache, self.releases[1:])
+        self.assertGreater(len(garbage), 0)
+        self.assertEqual(garbage & live, set())
+        shutil.rmtree(self.releases[0])
+        count, size = garbage_collect(self.binary_cache, self.releases[1:])
+        self.assertEqual(count, len(garbage))
+        for name in live:
+            self.assertTrue(os.path.isfile(os.path.join(self.releases[1], 'binary_cache', name)), name)
+        index = NarInfoIndex(os.path.join(self.outdir, 'narinfo-index.sqlite'))
+        self.assertEqual(index.releases(), [ os.path.realpath(self.releases[1]) ])
+        index.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import hashlib
+import http.server
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from nixipfs import mirror_tarballs as mt
+
+DATA = os.urandom(256 * 1024)
+
+class FlakyHandler(http.server.BaseHTTPRequestHandler):
+    """Cuts the first response off after a third of the body, serves ranges after that"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        r = self.headers.get('Range')
+        if r is None and self.server.fail:
+            self.server.fail = False
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(DATA)))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+            self.wfile.write(DATA[:len(DATA) // 3])
+            self.close_connection = True
+            return
+        start = int(r[len('bytes='):].split('-')[0]) if r else 0
+        self.send_response(206 if r else 200)
+        self.send_header('Content-Length', str(len(DATA) - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        if r:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(DATA) - 1, len(DATA)))
+        self.end_headers()
+        self.wfile.write(DATA[start:])
+
+    def log_message(self, *args):
+        pass
+
+def published_files(target_dir):
+    return [ os.path.relpath(os.path.join(root, f), target_dir)
+             for root, dirs, files in os.walk(target_dir) for f in files ]
+
+@mock.patch('nixipfs.mirror_tarballs.backoff_delay', lambda *args: 0)
+class FetchUrlTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.target_dir = os.path.join(self.tmp, 'tarballs')
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FlakyHandler)
+        self.server.fail = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}/a.tar.gz'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        shutil.rmtree(self.tmp)
+
+    def test_partial_download_is_not_published(self):
+        mt.create_mirror_dirs(self.target_dir, 'rev')
+        hashv = hashlib.sha256(DATA).hexdigest()
+        with self.assertRaises(mt.DownloadFailed):
+            mt.fetch_url(self.url, self.target_dir, hashv, 'sha256', tries=1)
+        self.assertEqual(published_files(self.target_dir), [])
+        self.assertNotEqual(published_files(mt.staging_dir(self.target_dir)), [])
+
+        # the next attempt continues the partial file and moves it into the mirror
+        res = mt.fetch_url(self.url, self.target_dir, hashv, 'sha256', tries=1)
+        self.assertTrue(res['path'].startswith(mt.staging_dir(self.target_dir)))
+        mt.mirror_file(self.target_dir, res['path'], 'a.tar.gz', 'rev', hashes=res['hashes'], move=True)
+        self.assertEqual(published_files(mt.staging_dir(self.target_dir)), [])
+        with open(os.path.join(self.target_dir, 'sha256', hashv), 'rb') as f:
+            self.assertEqual(f.read(), DATA)
+
+    def test_legacy_partials_are_removed(self):
+        sha512_dir = os.path.join(self.target_dir, 'sha512')
+        os.makedirs(os.path.join(sha512_dir, '.partial'))
+        for path in [ os.path.join(sha512_dir, '.partial', '.incoming-sha256-0'),
+                      os.path.join(sha512_dir, '.incoming-sha256-0') ]:
+            open(path, 'w').close()
+        mt.create_mirror_dirs(self.target_dir, 'rev')
+        self.assertEqual(os.listdir(sha512_dir), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import collections
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from nixipfs.benchmark import SyntheticCache, FakeBinaryCache
+from nixipfs.concurrency import AdaptiveLimiter, DiskBudget
+from nixipfs.update_binary_cache import update_binary_cache
+
+class CountingCache(FakeBinaryCache):
+    """Counts requests per path and the most requests that were in flight at once"""
+    def __init__(self, cache, delay):
+        self.delay = delay
+        self.paths = collections.Counter()
+        self.active = 0
+        self.peak = 0
+        FakeBinaryCache.__init__(self, cache)
+
+    def handle(self, method, path, query, headers, body):
+        with self.lock:
+            self.paths[path] += 1
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        try:
+            time.sleep(self.delay)
+            return FakeBinaryCache.handle(self, method, path, query, headers, body)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+class ConcurrentReleasesTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = SyntheticCache(paths=90, depth=3, refs=2, nar_size=(64, 256), churn=0.5)
+        self.server = CountingCache(self.cache, 0.01)
+        self.workdir = tempfile.mkdtemp(prefix='nixipfs-test')
+        self.outdir = os.path.join(self.workdir, 'out')
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.workdir)
+
+    def release(self, name, roots):
+        release = os.path.join(self.outdir, 'releases', name)
+        os.makedirs(release)
+        with open(os.path.join(release, 'store-paths'), 'w') as f:
+            f.write('\n'.join(roots))
+        return release
+
+    def sync(self, async_narinfo):
+        limiter = AdaptiveLimiter('test', initial=4, maximum=4)
+        budget = DiskBudget(1024 * 1024)
+        releases = [ self.release('r{}'.format(i), roots) for i, roots in enumerate(self.cache.roots) ]
+        threads = [ threading.Thread(target=update_binary_cache,
+                                     args=(self.server.url, release, self.outdir, 4),
+                                     kwargs={ 'async_narinfo' : async_narinfo, 'max_requests' : 4,
+                                              'limiter' : limiter, 'disk_budget' : budget })
+                    for release in releases ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # everything both closures share was requested once
+        self.assertEqual([ p for p, n in self.server.paths.items() if n > 1 ], [])
+        self.assertLessEqual(self.server.peak, 4)
+        for release in releases:
+            linked = os.path.join(release, 'binary_cache')
+            for root in open(os.path.join(release, 'store-paths')).read().split('\n'):
+                narinfo = os.path.join(linked, os.path.basename(root).split('-')[0] + '.narinfo')
+                self.assertTrue(os.path.isfile(narinfo), narinfo)
+            for nar in os.listdir(os.path.join(linked, 'nar')):
+                with open(os.path.join(linked, 'nar', nar), 'rb') as f:
+                    self.assertEqual(f.read(), self.cache.files[os.path.join('nar', nar)])
+
+    def test_threads(self):
+        self.sync(False)
+
+    def test_async(self):
+        self.sync(True)
+
+if __name__ == '__main__':
+    unittest.main()